@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+import functools
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+from os.path import basename, getsize, isdir, isfile, join
+
+
+@functools.lru_cache(maxsize=None)
+def tool_version(*cmd):
+    """Version text of an external tool, e.g. tool_version("potrace", "--version"); the command itself when it is missing."""
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+        return (result.stdout + result.stderr).strip() or " ".join(cmd)
+    except (OSError, subprocess.TimeoutExpired):
+        return " ".join(cmd)
+
+
+def source_version(*modules):
+    """Version of our own stages: the hash of the source files that implement them."""
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(join(os.path.dirname(os.path.abspath(__file__)), module), "rb") as fh:
+            digest.update(fh.read())
+    return digest.hexdigest()
+
+
+class ArtifactCache:
+    """Directory of stage outputs keyed by a hash of the stage's inputs, trimmed to max_bytes by least recent use.
+
+    Each entry is a directory named by its key holding copies of the stage's output files. A hit copies them back and
+    touches the entry, so eviction removes the entries unused for longest first.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(stage, files=(), config=None, tool=None):
+        """Hash of a stage name, the bytes of its input files, its configuration subtree and the version of its tool."""
+        digest = hashlib.sha256(stage.encode())
+        for path in files:
+            with open(path, "rb") as fh:
+                for chunk in iter(lambda: fh.read(1 << 20), b""):
+                    digest.update(chunk)
+            digest.update(b"\0")
+        digest.update(json.dumps(config, sort_keys=True, default=str).encode())
+        digest.update(str(tool).encode())
+        return f"{stage}-{digest.hexdigest()}"
+
+    def fetch(self, key, outputs=None):
+        """Copy a cached entry's files to their places; outputs maps file names in the entry to paths, None restores all."""
+        entry = join(self.cache_dir, key)
+        if not isdir(entry):
+            return False
+        with open(join(entry, "manifest.json")) as fh:
+            manifest = json.load(fh)
+        outputs = outputs or manifest
+        if not all(isfile(join(entry, name)) for name in outputs):
+            return False
+        for name, path in outputs.items():
+            shutil.copyfile(join(entry, name), path)
+        os.utime(entry)
+        return True
+
+    def store(self, key, paths):
+        """Copy the stage's output files into the entry for key, then evict down to max_bytes."""
+        entry = join(self.cache_dir, key)
+        tmp = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp, exist_ok=True)
+        manifest = {}
+        for path in paths:
+            shutil.copyfile(path, join(tmp, basename(path)))
+            manifest[basename(path)] = path
+        with open(join(tmp, "manifest.json"), "w") as fh:
+            json.dump(manifest, fh)
+        with self._lock:
+            if isdir(entry):
+                shutil.rmtree(entry)
+            # Rename into place so a concurrent run never sees a partial entry
+            os.replace(tmp, entry)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                entry = join(self.cache_dir, name)
+                if name.endswith(".tmp") or not isdir(entry):
+                    continue
+                size = sum(getsize(join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.stat(entry).st_mtime, size, entry))
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+                print(f"Cache: evicted {basename(entry)} ({size / (1 << 20):.1f}MB)")
+
+    def run(self, key, outputs, stage):
+        """Restore a stage's outputs from the cache, or call stage() and store them. Returns False when the stage failed.
+
+        outputs is a list of paths, or a callable listing them after the stage ran when they are not known up front (a
+        hit then restores every file the entry holds). A stage returning False failed and is not stored.
+        """
+        start_time = time.perf_counter()
+        if self.fetch(key, None if callable(outputs) else {basename(path): path for path in outputs}):
+            print(f"Cache: {key[:40]} hit, restored in {time.perf_counter() - start_time:.2f}s")
+            return True
+        if stage() is False:
+            print(f"Cache: not storing {key[:40]}, the stage failed")
+            return False
+        paths = outputs() if callable(outputs) else outputs
+        missing = [path for path in paths if not isfile(path)]
+        if missing:
+            print(f"Cache: not storing {key[:40]}, missing outputs {missing}")
+            return False
+        self.store(key, paths)
+        return True
@@ -0,0 +1,467 @@
+#!/usr/bin/python3
+import contextlib
+import glob
+import hashlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+from os.path import abspath, dirname, isfile, join
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+IMAGE_KINDS = ("gradient", "noise", "photo")
+IMAGE_BENCHMARKS = ("i2gc.process_level", "i2gc.process_custom_color", "i2gc.process", "i2gc.tiled", "pipeline")
+GCODE_BENCHMARKS = ("copicograf.prepare_path", "copicograf.peephole")
+BENCHMARKS = IMAGE_BENCHMARKS + GCODE_BENCHMARKS + ("startup",)
+
+# Interpreter startups timed by the startup benchmark, and the heavy modules none of them should load needlessly
+STARTUPS = {
+    "runner_help": ["image_to_gcode_runner.py", "--help"],
+    "i2gc_help": ["i2gc.py", "--help"],
+    "import_image_to_gcode_adaptive": ["-c", "import image_to_gcode_adaptive"],
+    "import_copicograf": ["-c", "import copicograf"],
+}
+HEAVY_MODULES = ("wand", "openscad_runner", "PIL.ImageCms", "cv2", "numpy", "PIL")
+
+# Fixed parameters of the benchmarked runs, so results stay comparable across commits
+LEVELS = 4
+WIDTH, HEIGHT = 100.0, 80.0
+CUSTOM_COLOR = "#DFC7A3"
+CUSTOM_CMYK = (31, 41, 89, 12)
+GCODE_SHAPES, GCODE_RINGS = 100, 5
+# Band heights of the tiled runs checked against the untiled one; 1 and odd heights put seams everywhere
+TILE_ROWS = (1, 7, 8, 13)
+
+
+def make_image(kind, size, seed=0):
+    """Deterministic size x (3 / 4 size) RGB test image: a smooth gradient, uniform noise, or photo-like.
+
+    Photo-like is a blurred low-resolution random field (large smooth areas), with hard-edged discs (sharp edges)
+    and a little grain on top, which gives level masks of realistic complexity.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size, size * 3 // 4
+    if kind == "gradient":
+        x = np.linspace(0, 255, width)[None, :].repeat(height, axis=0)
+        y = np.linspace(0, 255, height)[:, None].repeat(width, axis=1)
+        return Image.fromarray(np.stack([x, y, (x + y) / 2], axis=2).astype(np.uint8), "RGB")
+    if kind == "noise":
+        return Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), "RGB")
+    if kind == "photo":
+        field = Image.fromarray(rng.integers(0, 256, (6, 8, 3), dtype=np.uint8), "RGB").resize((width, height), Image.BICUBIC)
+        field = np.asarray(field.filter(ImageFilter.GaussianBlur(size / 64)), dtype=np.float64)
+        yy, xx = np.mgrid[0:height, 0:width]
+        for _ in range(12):
+            cx, cy, r = rng.uniform(0, width), rng.uniform(0, height), rng.uniform(size / 40, size / 8)
+            field[(xx - cx) ** 2 + (yy - cy) ** 2 < r * r] = rng.integers(0, 256, 3)
+        field += rng.normal(0, 6, field.shape)
+        return Image.fromarray(np.clip(field, 0, 255).astype(np.uint8), "RGB")
+    raise ValueError(f"Unknown image kind {kind}")
+
+
+def make_concentric_gcode(gcode_path, shapes=GCODE_SHAPES, rings=GCODE_RINGS, segments=64, seed=0):
+    """Write deterministic Cura-style concentric infill: shapes of rings loops of segments moves each, 1mm apart.
+
+    Each shape is a pen up (Z6), a travel to it and a pen down (Z1); each ring starts with G92 E0 and a move to its
+    start, as the slicer output Copicograf.prepare_path reads. Returns the number of painted segments.
+    """
+    rng = np.random.default_rng(seed)
+    e = 0.0
+    with open(gcode_path, "w") as fh:
+        fh.write(";FLAVOR:Marlin\n;Generated by benchmark.py\nG21\nG90\nM82\nG92 E0\n")
+        for _ in range(shapes):
+            cx, cy = rng.uniform(-WIDTH / 2 + 10, WIDTH / 2 - 10), rng.uniform(-HEIGHT / 2 + 10, HEIGHT / 2 - 10)
+            phase = rng.uniform(0, 2 * math.pi)
+            fh.write(f"G1 F600 Z6\nG0 F3000 X{cx + rings:.3f} Y{cy:.3f}\nG1 F600 Z1\n")
+            for ring in range(rings, 0, -1):
+                angles = phase + np.linspace(0, 2 * math.pi, segments + 1)
+                xs, ys = cx + ring * np.cos(angles), cy + ring * np.sin(angles)
+                fh.write(f"G92 E0\nG0 F3000 X{xs[0]:.3f} Y{ys[0]:.3f}\n")
+                e = 0.0
+                for x, y in zip(xs[1:], ys[1:]):
+                    e += 2 * math.pi * ring / segments * 0.05
+                    fh.write(f"G1 F1800 X{x:.3f} Y{y:.3f} E{e:.5f}\n")
+        fh.write("G1 F600 Z6\n")
+    return shapes * rings * segments
+
+
+def count_lines(paths):
+    lines = 0
+    for path in paths:
+        with open(path, "rb") as fh:
+            lines += sum(chunk.count(b"\n") for chunk in iter(lambda: fh.read(1 << 20), b""))
+    return lines
+
+
+def _i2gc(image_file, custom_colors=None, **kwargs):
+    from i2gc import I2GC
+
+    return I2GC(img_file=image_file, levels=LEVELS, width=WIDTH, height=HEIGHT, z_step=-7, custom_colors=custom_colors, workers=1, **kwargs)
+
+
+def tile_mismatches(workdir, input_file):
+    """Count the output files (G-code and previews) of tiled runs that differ from those of the untiled run.
+
+    The image is resized down (box filter) and up (Lanczos), and tiled TILE_ROWS rows at a time.
+    """
+    width, height = Image.open(input_file).size
+    mismatches = 0
+    for columns, rows in ((width * 3 // 5, height * 3 // 5), (width * 5 // 4, height * 5 // 4)):
+        digests = {}
+        for tile_rows in (None, *TILE_ROWS):
+            run_dir = join(workdir, f"tiles_{columns}_{tile_rows}")
+            os.makedirs(run_dir)
+            image_file = shutil.copy(input_file, run_dir)
+            _i2gc(image_file, [CUSTOM_COLOR], columns=columns, rows=rows, tile_rows=tile_rows).process()
+            os.remove(image_file)
+            digests[tile_rows] = {}
+            for name in os.listdir(run_dir):
+                with open(join(run_dir, name), "rb") as fh:
+                    digests[tile_rows][name] = hashlib.sha256(fh.read()).hexdigest()
+            shutil.rmtree(run_dir)
+        for tile_rows in TILE_ROWS:
+            mismatches += sum(digests[tile_rows].get(name) != digest for name, digest in digests[None].items())
+    return mismatches
+
+
+def _copicograf(result_file, peephole=False):
+    from copicograf import Copicograf
+
+    with open("small_machineM2.conf") as fh:
+        conf = json.load(fh)
+    conf["brushograph"]["peephole"] = peephole
+    # Copicograf draws the paint per run at random, the seed keeps the output identical between runs
+    random.seed(0)
+    return Copicograf(conf, result_file), (conf["trays"]["cyan"]["x"], conf["trays"]["cyan"]["y"])
+
+
+def _bench_process_level(workdir, input_file):
+    i2gc = _i2gc(input_file)
+    i2gc._prepare()
+    channels = len(i2gc.channels)
+
+    def run():
+        for channel in range(channels):
+            for j in range(LEVELS):
+                i2gc.process_level(channel, j)
+
+    return run, lambda: glob.glob(join(workdir, "*.gcode"))
+
+
+def _bench_process_custom_color(workdir, input_file):
+    i2gc = _i2gc(input_file)
+    i2gc._prepare()
+    channels = tuple(i2gc.channels)
+
+    def run():
+        i2gc.channels, i2gc._custom_channels = channels, []
+        i2gc.process_custom_color(CUSTOM_CMYK)
+
+    return run, lambda: []
+
+
+def _bench_process(workdir, input_file):
+    def run():
+        _i2gc(input_file, [CUSTOM_COLOR]).process()
+
+    return run, lambda: glob.glob(join(workdir, "*.gcode"))
+
+
+def _bench_tiled(workdir, input_file):
+    """process in bands of 64 rows; the tiled outputs that differ from the untiled ones are counted."""
+
+    def run():
+        _i2gc(input_file, [CUSTOM_COLOR], tile_rows=64).process()
+
+    return run, lambda: glob.glob(join(workdir, "*.gcode")), lambda: {"tile_mismatches": tile_mismatches(workdir, input_file)}
+
+
+def _bench_pipeline(workdir, input_file):
+    """In-process end to end for one color: level masks, contour tracing, native fill and Copicograf."""
+    from contour_trace import trace_contours
+    from fill_paths import fill_polygons
+
+    def run():
+        i2gc = _i2gc(input_file)
+        masks = i2gc.masks([("C", j) for j in range(LEVELS)])
+        mask = np.logical_or.reduce(list(masks.values()))
+        fill_polygons(trace_contours(mask), join(workdir, "fill.gcode"), WIDTH / mask.shape[1], HEIGHT / mask.shape[0])
+        copicograf, tray = _copicograf(join(workdir, "copicograf.gcode"))
+        copicograf.prepare_path(join(workdir, "fill.gcode"), *tray)
+        copicograf.save_gcode()
+
+    return run, lambda: [join(workdir, "copicograf.gcode")]
+
+
+def _bench_prepare_path(workdir, input_file):
+    result_file = join(workdir, "copicograf.gcode")
+
+    def run():
+        copicograf, tray = _copicograf(result_file)
+        copicograf.prepare_path(input_file, *tray)
+        copicograf.save_gcode()
+
+    return run, lambda: [result_file]
+
+
+def _bench_peephole(workdir, input_file):
+    """prepare_path with the peephole pass; the moves to where the tool already is that it left are counted."""
+    from gcode_peephole import repeated_moves
+
+    result_file = join(workdir, "copicograf.gcode")
+
+    def run():
+        copicograf, tray = _copicograf(result_file, peephole=True)
+        copicograf.prepare_path(input_file, *tray)
+        copicograf.save_gcode()
+
+    return run, lambda: [result_file], lambda: {"repeated_moves": repeated_moves(result_file)}
+
+
+def _bench_startup(workdir, startup):
+    """Time a fresh interpreter running one of STARTUPS; its output is the -X importtime list of imported modules."""
+    argv = [sys.executable, *STARTUPS[startup]]
+    importtime_file = join(workdir, "importtime.txt")
+
+    def run():
+        result = subprocess.run(argv, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"{' '.join(argv)} failed: {result.stderr[-500:]}")
+
+    def outputs():
+        # Listed in a separate, untimed run, as -X importtime slows the imports down
+        stderr = subprocess.run([argv[0], "-X", "importtime", *argv[1:]], capture_output=True, text=True).stderr
+        with open(importtime_file, "w") as fh:
+            fh.writelines(line + "\n" for line in stderr.splitlines() if line.startswith("import time:") and "|" in line and "cumulative" not in line)
+        return [importtime_file]
+
+    def extra():
+        with open(importtime_file) as fh:
+            modules = {line.split("|")[2].strip() for line in fh}
+        return {"heavy_modules": sorted(module for module in HEAVY_MODULES if module in modules)}
+
+    return run, outputs, extra
+
+
+_SETUPS = {
+    "i2gc.process_level": _bench_process_level,
+    "i2gc.process_custom_color": _bench_process_custom_color,
+    "i2gc.process": _bench_process,
+    "i2gc.tiled": _bench_tiled,
+    "pipeline": _bench_pipeline,
+    "copicograf.prepare_path": _bench_prepare_path,
+    "copicograf.peephole": _bench_peephole,
+    "startup": _bench_startup,
+}
+
+
+def _run_case(benchmark, source, repeat):
+    """Run one benchmark in this (fresh) process: untimed setup, then repeat timed runs. Returns its result entry."""
+    os.chdir(dirname(abspath(__file__)))
+    workdir = tempfile.mkdtemp(prefix="benchmark_")
+    try:
+        input_file = shutil.copy(source, workdir) if isfile(source) else source
+        # The hot paths report progress on stdout, which would drown the benchmark's own output
+        with contextlib.redirect_stdout(io.StringIO()):
+            run, outputs, *extra = _SETUPS[benchmark](workdir, input_file)
+            times = []
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                run()
+                times.append(time.perf_counter() - start_time)
+        # The startup benchmark measures the interpreters it starts, not this process
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN if benchmark == "startup" else resource.RUSAGE_SELF)
+        result = {
+            "wall_s": min(times),
+            "wall_median_s": statistics.median(times),
+            "runs": times,
+            "peak_rss_mb": usage.ru_maxrss / 1024,
+            "lines": count_lines(outputs()),
+        }
+        for fn in extra:
+            result.update(fn())
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=dirname(abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_suite(benchmarks=BENCHMARKS, kinds=IMAGE_KINDS, sizes=(256, 1024), segments=(32, 256), repeat=3, seed=0):
+    """Generate the inputs and run every benchmark on them, each in its own process so peak RSS is its own.
+
+    Returns a history entry: {"timestamp", "commit", ..., "results": {"benchmark:input": result}}.
+    """
+    inputs_dir = tempfile.mkdtemp(prefix="benchmark_inputs_")
+    results = {}
+    try:
+        cases = []
+        for benchmark in benchmarks:
+            if benchmark in IMAGE_BENCHMARKS:
+                for kind in kinds:
+                    for size in sizes:
+                        source = join(inputs_dir, f"{kind}_{size}.png")
+                        if not isfile(source):
+                            make_image(kind, size, seed).save(source)
+                        cases.append((f"{benchmark}:{kind}:{size}", benchmark, source))
+            elif benchmark == "startup":
+                cases += [(f"startup:{startup}", benchmark, startup) for startup in STARTUPS]
+            else:
+                for count in segments:
+                    source = join(inputs_dir, f"concentric_{count}.gcode")
+                    if not isfile(source):
+                        make_concentric_gcode(source, segments=count, seed=seed)
+                    cases.append((f"{benchmark}:concentric:{GCODE_SHAPES * GCODE_RINGS * count}", benchmark, source))
+        for name, benchmark, source in cases:
+            # spawn rather than fork, so nothing the parent allocated counts towards the case's peak RSS
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                results[name] = executor.submit(_run_case, benchmark, source, repeat).result()
+            result = results[name]
+            print(
+                f"{name}: {result['wall_s']:.3f}s (median {result['wall_median_s']:.3f}s), {result['peak_rss_mb']:.0f}MB, {result['lines']} lines"
+                + (f", loads {', '.join(result['heavy_modules']) or 'no heavy modules'}" if "heavy_modules" in result else "")
+                + (f", {result['repeated_moves']} repeated moves" if "repeated_moves" in result else "")
+                + (f", {result['tile_mismatches']} tiled outputs differ" if "tile_mismatches" in result else "")
+            )
+    finally:
+        shutil.rmtree(inputs_dir, ignore_errors=True)
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()} {os.cpu_count()} CPUs",
+        "repeat": repeat,
+        "seed": seed,
+        "results": results,
+    }
+
+
+def load_history(history_file):
+    if not isfile(history_file):
+        return []
+    with open(history_file) as fh:
+        return json.load(fh)
+
+
+def save_history(history_file, history):
+    tmp = f"{history_file}.tmp"
+    with open(tmp, "w") as fh:
+        json.dump(history, fh, indent=1)
+    os.replace(tmp, history_file)
+
+
+def compare(baseline, current, time_threshold=0.10, rss_threshold=0.20, min_time=0.01):
+    """Compare two history entries. Returns (rows, regressions) where rows are printable comparisons per benchmark.
+
+    A benchmark regresses when its best wall time is more than time_threshold slower (and by at least min_time
+    seconds, below which timing noise dominates), its peak RSS more than rss_threshold larger, or its output line
+    count differs, which means the output changed. The peephole benchmark also fails on any repeated move left, and
+    the tiled one on any output that differs from the untiled run's.
+    """
+    rows, regressions = [], []
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            flags = [flag for flag, key in (("repeated moves", "repeated_moves"), ("tile mismatches", "tile_mismatches")) if result.get(key)]
+            rows.append(f"{name}: new, {result['wall_s']:.3f}s" + (f"  REGRESSION ({', '.join(flags)})" if flags else ""))
+            if flags:
+                regressions.append(name)
+            continue
+        flags = []
+        if result["wall_s"] > base["wall_s"] * (1 + time_threshold) and result["wall_s"] - base["wall_s"] >= min_time:
+            flags.append("time")
+        if result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + rss_threshold):
+            flags.append("rss")
+        if result["lines"] != base["lines"]:
+            flags.append("lines")
+        if result.get("repeated_moves"):
+            flags.append("repeated moves")
+        if result.get("tile_mismatches"):
+            flags.append("tile mismatches")
+        rows.append(
+            f"{name}: {base['wall_s']:.3f}s -> {result['wall_s']:.3f}s ({100 * (result['wall_s'] / max(base['wall_s'], 1e-9) - 1):+.1f}%), "
+            f"{base['peak_rss_mb']:.0f}MB -> {result['peak_rss_mb']:.0f}MB, {base['lines']} -> {result['lines']} lines"
+            + (f"  REGRESSION ({', '.join(flags)})" if flags else "")
+        )
+        if flags:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main():
+    import argparse
+
+    argparser = argparse.ArgumentParser(description="Benchmark the hot paths on generated inputs and track the results")
+    argparser.add_argument("--history", dest="history", default="benchmark_history.json", help="History file the runs are appended to", type=str)
+    argparser.add_argument("--baseline", dest="baseline", default="benchmark_baseline.json", help="Stored baseline run", type=str)
+    commands = argparser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Run the benchmarks and append the results to the history")
+    run_parser.add_argument("-b", "--benchmarks", dest="benchmarks", default=list(BENCHMARKS), nargs="+", choices=BENCHMARKS, help="Benchmarks to run", type=str)
+    run_parser.add_argument("-k", "--kinds", dest="kinds", default=list(IMAGE_KINDS), nargs="+", choices=IMAGE_KINDS, help="Image kinds", type=str)
+    run_parser.add_argument("-s", "--sizes", dest="sizes", default=[256, 1024], nargs="+", help="Image widths in pixels", type=int)
+    run_parser.add_argument("--segments", dest="segments", default=[32, 256], nargs="+", help="Segments per ring of the generated concentric G-code", type=int)
+    run_parser.add_argument("-r", "--repeat", dest="repeat", default=3, help="Timed runs per benchmark, the best one counts", type=int)
+    run_parser.add_argument("--seed", dest="seed", default=0, help="Seed of the generated inputs", type=int)
+    run_parser.add_argument("--set-baseline", dest="set_baseline", action="store_true", help="Also store this run as the baseline")
+    baseline_parser = commands.add_parser("baseline", help="Store a run from the history as the baseline")
+    baseline_parser.add_argument("-n", "--run", dest="run", default=-1, help="Index of the run in the history (default: latest)", type=int)
+    compare_parser = commands.add_parser("compare", help="Compare a run from the history with the baseline, exit 1 on regressions")
+    compare_parser.add_argument("-n", "--run", dest="run", default=-1, help="Index of the run in the history (default: latest)", type=int)
+    compare_parser.add_argument("-t", "--time-threshold", dest="time_threshold", default=0.10, help="Allowed slowdown (0.10: 10%%)", type=float)
+    compare_parser.add_argument("-m", "--rss-threshold", dest="rss_threshold", default=0.20, help="Allowed peak RSS growth (0.20: 20%%)", type=float)
+    args = argparser.parse_args()
+
+    history = load_history(args.history)
+    if args.command == "run":
+        entry = run_suite(args.benchmarks, args.kinds, args.sizes, args.segments, args.repeat, args.seed)
+        history.append(entry)
+        save_history(args.history, history)
+        print(f"Appended run {len(history) - 1} to {args.history}")
+        if args.set_baseline:
+            save_history(args.baseline, entry)
+            print(f"Stored run {len(history) - 1} as the baseline in {args.baseline}")
+        return
+    if not history:
+        print(f"Error: No runs in {args.history}")
+        sys.exit(1)
+    entry = history[args.run]
+    if args.command == "baseline":
+        save_history(args.baseline, entry)
+        print(f"Stored run {args.run % len(history)} ({entry['timestamp']}, {entry['commit']}) as the baseline in {args.baseline}")
+        return
+    if not isfile(args.baseline):
+        print(f"Error: No baseline in {args.baseline}, store one with the baseline command")
+        sys.exit(1)
+    with open(args.baseline) as fh:
+        baseline = json.load(fh)
+    print(f"Baseline {baseline['timestamp']} ({baseline['commit']}) vs run {args.run % len(history)} {entry['timestamp']} ({entry['commit']})")
+    rows, regressions = compare(baseline, entry, args.time_threshold, args.rss_threshold)
+    for row in rows:
+        print(f"  {row}")
+    if regressions:
+        print(f"{len(regressions)} regressions")
+        sys.exit(1)
+    print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+import hashlib
+import threading
+from os import getpid, makedirs, replace
+from os.path import isfile, join
+
+import numpy as np
+from PIL import Image
+
+# ImageCms.Intent.PERCEPTUAL. ImageCms (and its littleCMS engine) is imported only when a transform is built, so
+# jobs served from the LUT cache never load it
+PERCEPTUAL = 0
+
+# Built ImageCms transforms and loaded LUTs, keyed by (input profile, output profile, intent, input mode, output mode)
+_transforms = {}
+_luts = {}
+_lock = threading.Lock()
+
+
+def get_transform(input_profile, output_profile, input_mode, output_mode, intent=PERCEPTUAL):
+    """Return a cached ImageCms transform, building it (and parsing both profiles) only on first use."""
+    from PIL import ImageCms
+
+    key = (input_profile, output_profile, intent, input_mode, output_mode)
+    with _lock:
+        if key not in _transforms:
+            _transforms[key] = ImageCms.buildTransform(input_profile, output_profile, input_mode, output_mode, intent)
+        return _transforms[key]
+
+
+def _lut_file(lut_dir, input_profile, output_profile, output_mode, intent):
+    digest = hashlib.sha256()
+    for profile in (input_profile, output_profile):
+        with open(profile, "rb") as fh:
+            digest.update(fh.read())
+    digest.update(f"{int(intent)}:RGB:{output_mode}".encode())
+    return join(lut_dir, f"{digest.hexdigest()}.npy")
+
+
+def get_lut(lut_dir, input_profile, output_profile, output_mode, intent=PERCEPTUAL):
+    """Return a 256x256x256 RGB lookup table of the transform, persisted in lut_dir so later jobs skip the profiles."""
+    key = (input_profile, output_profile, intent, "RGB", output_mode)
+    with _lock:
+        if key in _luts:
+            return _luts[key]
+    lut_file = _lut_file(lut_dir, input_profile, output_profile, output_mode, intent)
+    if isfile(lut_file):
+        lut = np.load(lut_file, mmap_mode="r")
+    else:
+        from PIL import ImageCms
+
+        # Every 8-bit RGB value once, so lookups are exact rather than interpolated
+        codes = np.arange(1 << 24, dtype=np.uint32)
+        rgb = np.stack([codes >> 16, (codes >> 8) & 255, codes & 255], axis=-1).astype(np.uint8)
+        sampled = ImageCms.applyTransform(Image.frombytes("RGB", (4096, 4096), rgb.tobytes()), get_transform(input_profile, output_profile, "RGB", output_mode, intent))
+        lut = np.asarray(sampled).reshape(256, 256, 256, -1)
+        makedirs(lut_dir, exist_ok=True)
+        # Rename into place so concurrent jobs never load a partial file
+        np.save(f"{lut_file}.{getpid()}.npy", lut)
+        replace(f"{lut_file}.{getpid()}.npy", lut_file)
+    with _lock:
+        _luts[key] = lut
+    return lut
+
+
+def convert(image, input_profile, output_profile, output_mode, intent=PERCEPTUAL, lut_dir=None):
+    """Same result as ImageCms.profileToProfile, with cached transforms and an optional on-disk LUT for RGB input."""
+    if lut_dir and image.mode == "RGB":
+        lut = get_lut(lut_dir, input_profile, output_profile, output_mode, intent)
+        rgb = np.asarray(image)
+        return Image.frombytes(output_mode, image.size, np.ascontiguousarray(lut[rgb[..., 0], rgb[..., 1], rgb[..., 2]]).tobytes())
+    from PIL import ImageCms
+
+    return ImageCms.applyTransform(image, get_transform(input_profile, output_profile, image.mode, output_mode, intent))
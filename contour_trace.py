@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def read_mask(png_file):
+    """Ink mask of an i2gc level preview: any pixel that is not white, however light the ink color."""
+    return (np.asarray(Image.open(png_file).convert("RGB")) != 255).any(axis=2)
+
+
+def trace_contours(mask, epsilon=0.5, turdsize=2, upsample=2):
+    """Trace the outlines and holes of the ink in a mask as polygons in pixel units, y down.
+
+    Like potrace the outline follows the pixel edges rather than their centres: the mask is traced at `upsample` times
+    the resolution, which leaves the outline within 1 / (2 * upsample) px of the edges, and then simplified with
+    Douglas-Peucker to `epsilon` px. Shapes and holes smaller than `turdsize` px are dropped, as potrace's -t does.
+    """
+    if upsample > 1:
+        mask = mask.repeat(upsample, axis=0).repeat(upsample, axis=1)
+    contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    polygons = []
+    for contour in contours:
+        if abs(cv2.contourArea(contour)) < turdsize * upsample * upsample:
+            continue
+        approx = cv2.approxPolyDP(contour, epsilon * upsample, True).reshape(-1, 2)
+        polygons.append((approx + 0.5) / upsample)
+    return polygons
+
+
+def write_svg(polygons, width, height, svg_file):
+    """Write polygons as one even-odd filled path, sized like potrace's SVG output (1pt per pixel)."""
+    path = " ".join("M" + " L".join(f"{x:g} {y:g}" for x, y in polygon) + " Z" for polygon in polygons if len(polygon) > 2)
+    with open(svg_file, "w") as fh:
+        fh.write('<?xml version="1.0" standalone="no"?>\n')
+        fh.write(f'<svg version="1.0" xmlns="http://www.w3.org/2000/svg" width="{width}pt" height="{height}pt" viewBox="0 0 {width} {height}">\n')
+        fh.write(f'<path d="{path}" fill="#000000" fill-rule="evenodd" stroke="none"/>\n')
+        fh.write("</svg>\n")
+
+
+def trace_svg(mask, svg_file, epsilon=0.5, turdsize=2):
+    """Trace a mask straight to an SVG, in place of writing a PBM and running potrace on it. Returns the polygons."""
+    polygons = trace_contours(mask, epsilon, turdsize)
+    write_svg(polygons, mask.shape[1], mask.shape[0], svg_file)
+    return polygons
+
+
+def main():
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-i", "--input", dest="input", default=None, help="Input level image (i2gc preview PNG)", type=str, required=True)
+    argparser.add_argument("-o", "--output", dest="output", default=None, help="Output svg", type=str, required=True)
+    argparser.add_argument("-e", "--epsilon", dest="epsilon", default=0.5, help="Simplification tolerance in pixels", type=float)
+    argparser.add_argument("-t", "--turdsize", dest="turdsize", default=2, help="Drop shapes smaller than this many pixels", type=int)
+    args = argparser.parse_args()
+
+    polygons = trace_svg(read_mask(args.input), args.output, args.epsilon, args.turdsize)
+    print(f"Traced {len(polygons)} contours, {sum(len(polygon) for polygon in polygons)} points")
+
+
+if __name__ == "__main__":
+    main()
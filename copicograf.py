@@ -1,14 +1,27 @@
 #!/usr/bin/python3
-from pygcode import Line, GCodeLinearMove, GCodeRapidMove
 import math
+import os
 import random
+import tempfile
+import time
+
+from gcode_reader import compressed_path, compression_of, copy_gcode, open_gcode as open_gcode_file, read_gcode, matches, get_xy
+from gcode_writer import GCodeWriter
+from stage_stats import StageStats
 
 
 class Copicograf:
-    def __init__(self, conf, gcodes=[]):
+    def __init__(self, conf, result_file="copicograf.gcode", stats=None):
         self.conf = conf
+        # Stage timers and counters, shared with the caller when given one
+        self.stats = stats if stats is not None else StageStats()
 
-        self.gcodes = gcodes
+        # Moves are streamed to a temporary file of this instance next to result_file as prepare_path generates them,
+        # and save_gcode moves it into place; compressed if result_file ends in .gz or .zst
+        self.result_file = result_file
+        self._part_file = None
+        self._gcfh = None
+        self.gcodes = None
 
         self.water_tray_x = int(self.conf["trays"]["water"]["x"])
         self.water_tray_y = int(self.conf["trays"]["water"]["y"])
@@ -25,8 +38,9 @@ class Copicograf:
         self.offset_x = float(self.conf["brushograph"]["offset_x"])
         self.paint_per_run_min = int(self.conf["brushograph"]["paint_per_run_min"])
         self.paint_per_run_max = int(self.conf["brushograph"]["paint_per_run_max"])
+        self.plan_paint_dips = bool(self.conf["brushograph"].get("plan_paint_dips", False))
+        self.peephole = bool(self.conf["brushograph"].get("peephole", False))
         self.randomize_paint_per_run()
-        self.result_file = "copicograf.gcode"
 
         self.prepare_paint_count = int(self.conf["brushograph"]["prepare_paint_count"])
 
@@ -48,46 +62,69 @@ class Copicograf:
 
         # self.paint_per_run = 300
 
-    # def run_machine(self, gcode_result):
-
-    # p = printcore('/dev/cu.usbserial-2130', 115200)
-    # or pass in your own array of gcode lines instead of reading from a file
-    # gcode = [i.strip() for i in open(gcode_result)]
-    # gcode = gcoder.LightGCode(gcode)
-
-    # startprint silently exits if not connected yet
-    # while not p.online:
-    #     time.sleep(0.1)
-
-    # p.startprint(gcode)
-
-    def save_gcode(self, result_file):
-        gcfh = open(result_file, "w+")
-        gcfh.write("\n".join(str(g) for g in self.gcodes))
-        gcfh.close()
+    def run_machine(self, port, baud=115200, **kwargs):
+        """Stream the saved result file to the machine on port, e.g. "/dev/cu.usbserial-2130"; see gcode_sender."""
+        from gcode_sender import send_gcode
+
+        return send_gcode(self.result_file, port, baud, **kwargs)
+
+    def open_gcode(self):
+        if self.gcodes is None:
+            # A file of its own, so instances writing the same result_file at once do not write over each other
+            fd, self._part_file = tempfile.mkstemp(prefix=f".{os.path.basename(self.result_file)}.", suffix=compressed_path(".part", compression_of(self.result_file)), dir=os.path.dirname(os.path.abspath(self.result_file)))
+            os.close(fd)
+            self._gcfh = open_gcode_file(self._part_file, "w")
+            self.gcodes = GCodeWriter(self._gcfh, peephole=self.peephole)
+        return self.gcodes
+
+    def save_gcode(self, result_file=None):
+        """Finish the streamed output and move it to result_file, by default the one given to the constructor.
+
+        The output is recompressed on the way when result_file's extension asks for another compression (or none).
+        """
+        self.open_gcode()
+        self.gcodes.flush()
+        if self.gcodes.peephole:
+            print(f"Peephole: {self.gcodes.peephole.report()}")
+        self._gcfh.close()
+        self._gcfh, self.gcodes = None, None
+        result_file = result_file or self.result_file
+        if compression_of(result_file) == compression_of(self._part_file):
+            # mkstemp makes the file private to the user
+            os.chmod(self._part_file, 0o644)
+            os.replace(self._part_file, result_file)
+        else:
+            copy_gcode(self._part_file, result_file)
+            os.remove(self._part_file)
+        self.result_file, self._part_file = result_file, None
 
     def prepare_path(self, gcode_path, color_tray_x, color_tray_y):
+        self.open_gcode()
+        start_time = time.perf_counter()
+        start_lines, start_bytes = self.gcodes.lines, self.gcodes.bytes
+        counts = {"dips": 0, "washes": 0, "painted_mm": 0.0}
+
         def set_normal_speed():
-            self.gcodes.append(self.initial_gcode_acc)
-            self.gcodes.append(self.initial_gcode_feedrate_1)
-            self.gcodes.append(self.initial_gcode_feedrate_2)
+            self.gcodes.raw(self.initial_gcode_acc)
+            self.gcodes.raw(self.initial_gcode_feedrate_1)
+            self.gcodes.raw(self.initial_gcode_feedrate_2)
 
         def set_fast_speed():
-            self.gcodes.append(self.paint_gcode_acc)
-            self.gcodes.append(self.paint_gcode_feedrate_1)
-            self.gcodes.append(self.paint_gcode_feedrate_2)
+            self.gcodes.raw(self.paint_gcode_acc)
+            self.gcodes.raw(self.paint_gcode_feedrate_1)
+            self.gcodes.raw(self.paint_gcode_feedrate_2)
 
         def set_remove_drops_speed():
-            self.gcodes.append(self.remove_drops_gcode_acc)
-            self.gcodes.append(self.remove_drops_gcode_feedrate_1)
-            self.gcodes.append(self.remove_drops_gcode_feedrate_2)
+            self.gcodes.raw(self.remove_drops_gcode_acc)
+            self.gcodes.raw(self.remove_drops_gcode_feedrate_1)
+            self.gcodes.raw(self.remove_drops_gcode_feedrate_2)
 
         set_normal_speed()
-        self.gcodes.append("G90 ; sets absolute positioning")
-        self.gcodes.append("G21 ; set units to millimeters")
-        self.gcodes.append("M400 ; finish moves")
-        self.gcodes.append(GCodeRapidMove(z=self.go_in_tray_lift))
-        self.gcodes.append("G28 X Y ; home the X and Y axes only")
+        self.gcodes.raw("G90 ; sets absolute positioning")
+        self.gcodes.raw("G21 ; set units to millimeters")
+        self.gcodes.raw("M400 ; finish moves")
+        self.gcodes.rapid(Z=self.go_in_tray_lift)
+        self.gcodes.raw("G28 X Y ; home the X and Y axes only")
 
         self.dist_painted = 0
 
@@ -158,10 +195,10 @@ class Copicograf:
             x1, y1 = get_relative_point(tray_x, tray_y, x + self.offset_x, y + self.offset_y, ratioStart)
             x2, y2 = get_relative_point(tray_x, tray_y, x + self.offset_x, y + self.offset_y, ratioEnb)
 
-            self.gcodes.append(GCodeLinearMove(X=x1, Y=y1))
-            self.gcodes.append(GCodeLinearMove(Z=self.remove_drops_lift))
+            self.gcodes.linear(X=x1, Y=y1)
+            self.gcodes.linear(Z=self.remove_drops_lift)
             set_remove_drops_speed()
-            self.gcodes.append(GCodeLinearMove(X=x2, Y=y2))
+            self.gcodes.linear(X=x2, Y=y2)
             set_fast_speed()
 
         def append_go_in_tray(tray_x, tray_y, x, y, num_of_entries=1, remove_drop=True):
@@ -170,19 +207,19 @@ class Copicograf:
                 first_coords, second_coords = get_coords_in_tray(tray_x, tray_y)
                 if i == 0:
                     if self.move_to_other_shape_lift + self.canvas_height > self.go_in_tray_lift:
-                        self.gcodes.append(GCodeRapidMove(Z=self.move_to_other_shape_lift + self.canvas_height))
+                        self.gcodes.rapid(Z=self.move_to_other_shape_lift + self.canvas_height)
                     else:
-                        self.gcodes.append(GCodeRapidMove(Z=self.go_in_tray_lift))
+                        self.gcodes.rapid(Z=self.go_in_tray_lift)
                 else:
-                    self.gcodes.append(GCodeRapidMove(Z=self.go_in_tray_lift))
+                    self.gcodes.rapid(Z=self.go_in_tray_lift)
 
                 if first_coords[1] > 1000 or second_coords[1] > 1000:
                     print("napaka")
 
-                self.gcodes.append(GCodeRapidMove(X=first_coords[0], Y=first_coords[1]))
-                self.gcodes.append(GCodeRapidMove(Z=-4))
-                self.gcodes.append(GCodeRapidMove(X=second_coords[0], Y=second_coords[1]))
-                self.gcodes.append(GCodeRapidMove(Z=self.go_in_tray_lift))
+                self.gcodes.rapid(X=first_coords[0], Y=first_coords[1])
+                self.gcodes.rapid(Z=-4)
+                self.gcodes.rapid(X=second_coords[0], Y=second_coords[1])
+                self.gcodes.rapid(Z=self.go_in_tray_lift)
 
             if remove_drop == True:
                 remove_drops(tray_x, tray_y, x, y)
@@ -194,16 +231,17 @@ class Copicograf:
             #     Z=self.canvas_height + self.move_to_other_shape_lift))
 
             if self.move_to_other_shape_lift + self.canvas_height > self.go_in_tray_lift:
-                self.gcodes.append(GCodeRapidMove(Z=self.move_to_other_shape_lift + self.canvas_height))
+                self.gcodes.rapid(Z=self.move_to_other_shape_lift + self.canvas_height)
             else:
-                self.gcodes.append(GCodeRapidMove(Z=self.go_in_tray_lift))
+                self.gcodes.rapid(Z=self.go_in_tray_lift)
 
-            self.gcodes.append(GCodeRapidMove(X=x + self.offset_x, Y=y + self.offset_y))
-            self.gcodes.append(GCodeRapidMove(Z=self.canvas_height))
+            self.gcodes.rapid(X=x + self.offset_x, Y=y + self.offset_y)
+            self.gcodes.rapid(Z=self.canvas_height)
             set_normal_speed()
 
         def append_go_for_paint(x, y):
             append_go_in_tray(color_tray_x, color_tray_y, x, y)
+            counts["dips"] += 1
 
             # self.randomize_paint_per_run()
 
@@ -211,6 +249,7 @@ class Copicograf:
 
         def wash_the_brush(x, y):
             append_go_in_tray(self.water_tray_x, self.water_tray_y, x, y, 3, False)
+            counts["washes"] += 1
 
         def prepare_paint(x, y):
             append_go_in_tray(color_tray_x, color_tray_y, x, y, self.prepare_paint_count, True)
@@ -235,7 +274,7 @@ class Copicograf:
             first_point_x = int(x1 + (x_operator * first_delta_x))
             first_point_y = int(y1 + (y_operator * first_delta_y))
 
-            self.gcodes.append(GCodeLinearMove(X=first_point_x + self.offset_x, Y=first_point_y + self.offset_y))
+            self.gcodes.linear(X=first_point_x + self.offset_x, Y=first_point_y + self.offset_y)
 
             append_go_for_paint(first_point_x, first_point_y)
 
@@ -265,7 +304,7 @@ class Copicograf:
             new_point_x = previous_point_x + (int(delta_x) * x_operator)
             new_point_y = previous_point_y + (int(delta_y) * y_operator)
 
-            self.gcodes.append(GCodeLinearMove(X=new_point_x + self.offset_x, Y=new_point_y + self.offset_y))
+            self.gcodes.linear(X=new_point_x + self.offset_x, Y=new_point_y + self.offset_y)
 
             append_go_for_paint(new_point_x, new_point_y)
 
@@ -284,7 +323,7 @@ class Copicograf:
             for i in range(num_of_long_strokes):
                 previous_point_x, previous_point_y = append_intermediate_point(previous_point_x, previous_point_y, x2, y2)
 
-            self.gcodes.append(GCodeLinearMove(X=x2 + self.offset_x, Y=y2 + self.offset_y))
+            self.gcodes.linear(X=x2 + self.offset_x, Y=y2 + self.offset_y)
 
             remaining_dist = calculate_dist(previous_point_x, previous_point_y, x2, y2)
             return remaining_dist
@@ -295,21 +334,25 @@ class Copicograf:
         def append_dist_painted(dist):
             self.dist_painted += dist
 
-        def get_linear_moves(line):
-            result = []
-            for gcode in line.block.gcodes:
-                if isinstance(gcode, GCodeRapidMove):
-                    result.append(gcode)
-                if isinstance(gcode, GCodeLinearMove):
-                    result.append(gcode)
-            return result
-
-        def get_coords(line):
-            moves = get_linear_moves(line)
-            for move in moves:
-                if move.X is not None and move.Y is not None:
-                    return move, line.block.modal_params
-            return None, None
+        def append_planned_start_dip(x, y):
+            """Dip before the brush goes down on a stroke, if the plan puts a dip here."""
+            plan = self.paint_plan
+            if self.next_dip < len(plan) and plan.at_start[self.next_dip] and plan.distances[self.next_dip] <= self.painted_total + 1e-9:
+                append_go_for_paint(x, y)
+                self.next_dip += 1
+
+        def append_planned_segment(dist, x1, y1, x2, y2):
+            """Paint a segment, stopping for paint at every planned dip that falls on it."""
+            plan = self.paint_plan
+            end = self.painted_total + dist
+            while self.next_dip < len(plan) and not plan.at_start[self.next_dip] and plan.distances[self.next_dip] <= end + 1e-9:
+                ratio = (plan.distances[self.next_dip] - self.painted_total) / dist if dist else 1
+                point_x, point_y = x1 + (x2 - x1) * ratio, y1 + (y2 - y1) * ratio
+                self.gcodes.linear(X=float(point_x + self.offset_x), Y=float(point_y + self.offset_y))
+                append_go_for_paint(point_x, point_y)
+                self.next_dip += 1
+            self.gcodes.linear(X=float(x2 + self.offset_x), Y=float(y2 + self.offset_y))
+            self.painted_total = end
 
         # Mix the color
         prepare_paint(0, 0)
@@ -320,8 +363,7 @@ class Copicograf:
         # Go for paint before starting
         append_go_for_paint(0, 0)
 
-        self.last_draw_gcode = None
-        self.last_draw_params = None
+        self.last_draw_point = None
         self.append_paint_dist = False
         self.lines_painted = 0
 
@@ -329,124 +371,135 @@ class Copicograf:
         self.extruding = False
         self.move_to_other_shape = False
 
-        self.brush_above_canvas_gcode = GCodeRapidMove(Z=self.move_to_other_shape_lift + self.canvas_height)
-
-        self.brush_on_canvas_gcode = GCodeRapidMove(Z=self.canvas_height)
+        self.paint_plan = None
+        if self.plan_paint_dips:
+            # numpy is only needed for planning
+            from paint_planner import plan_paint_dips
+
+            self.paint_plan = plan_paint_dips(
+                gcode_path, color_tray_x, color_tray_y, self.paint_per_run_min, self.paint_per_run_max, self.offset_x, self.offset_y,
+                2 * self.tray_enter_radius + self.remove_drops_radius,
+            )
+            print(
+                f"Paint dips for {gcode_path}: {len(self.paint_plan)} planned ({self.paint_plan.naive_dips} unplanned), "
+                f"tray travel {self.paint_plan.tray_travel:.0f}mm (saved {self.paint_plan.naive_tray_travel - self.paint_plan.tray_travel:.0f}mm)"
+            )
+        self.next_dip = 0
+        self.painted_total = 0.0
 
         counter = 0
-
-        self.gcodes.append(self.brush_above_canvas_gcode)
-        with open(gcode_path) as fh:
-            for line_text in fh.readlines():
-                line = None
-                try:
-                    line = Line(line_text)
-                except AssertionError:
+        lines_read = 0
+        parse_start = time.perf_counter()
+
+        self.gcodes.rapid(Z=self.move_to_other_shape_lift + self.canvas_height)
+        for line in read_gcode(gcode_path):
+            lines_read += 1
+
+            if matches(line, 1, F=600, Z=6):  # G01 Z6 F600
+                # print("going up")
+                self.gcodes.rapid(Z=self.move_to_other_shape_lift + self.canvas_height)
+                self.brush_on_canvas = False
+
+                set_fast_speed()
+
+            if matches(line, 1, F=600, Z=1):  # G1 F600 Z1
+                # print("going down")
+                # self.gcodes.rapid(Z=self.canvas_height)
+                self.brush_on_canvas = True
+                self.move_to_other_shape = True
+
+            if matches(line, 92, E=0) and self.brush_on_canvas:
+                # print("start extrusion")
+                self.extruding = True
+                self.gcodes.rapid(Z=self.move_to_other_shape_lift + self.canvas_height)
+                set_fast_speed()
+                continue
+
+            point = get_xy(line)
+            if point is None:
+                continue
+
+            x, y = point
+
+            if x > 1000 and y > 1000:
+                print("napaka 2, x: ", x, ", y: ", y)
+
+            # print("x: ",x,", y: ",y,", params: ",line.block.modal_params)
+            # if len(line.block.modal_params)==1 and get_E_value(params) == 13652.6:
+            # print("line ",line)
+
+            if self.brush_on_canvas == True:
+                # if len(line.block.modal_params)==0:
+                #     # print("skip drawing this move")
+                #     continue
+                if (self.move_to_other_shape or self.extruding) and self.paint_plan is not None:
+                    append_planned_start_dip(x, y)
+                if self.move_to_other_shape == True:
+                    self.move_to_other_shape = False
+                    self.last_draw_point = point
+                    self.gcodes.linear(X=float(x + self.offset_x), Y=float(y + self.offset_y))
+                    self.gcodes.rapid(Z=self.canvas_height)
+                    set_normal_speed()
                     continue
-                text = str(line)
-                # print("text: ",text)
-
-                if text.strip() == "G1 F600 Z6" or text.strip() == "G01 Z6 F600":  # G01 Z6 F600
-                    # print("going up")
-                    self.gcodes.append(self.brush_above_canvas_gcode)
-                    self.brush_on_canvas = False
-
-                    set_fast_speed()
-
-                if text.strip() == "G01 Z1 F600" or text.strip() == "G1 F600 Z1":  # G1 F600 Z1
-                    # print("going down")
-                    # self.gcodes.append(self.brush_on_canvas_gcode)
-                    self.brush_on_canvas = True
-                    self.move_to_other_shape = True
-
-                if text.strip() == "G92 E0" and self.brush_on_canvas:
-                    # print("start extrusion")
-                    self.extruding = True
-                    self.gcodes.append(self.brush_above_canvas_gcode)
-                    set_fast_speed()
+                # G92 E0
+
+                if self.extruding == True:
+                    self.extruding = False
+                    self.last_draw_point = point
+                    self.gcodes.linear(X=float(x + self.offset_x), Y=float(y + self.offset_y))
+                    self.gcodes.rapid(Z=self.canvas_height)
+                    set_normal_speed()
                     continue
 
-                gcode, params = get_coords(line)
-                if gcode is None:
-                    continue
-
-                x = float(gcode.X)
-                y = float(gcode.Y)
-
-                if x > 1000 and y > 1000:
-                    print("napaka 2, x: ", x, ", y: ", y)
-
-                # print("x: ",x,", y: ",y,", params: ",line.block.modal_params)
-                # if len(line.block.modal_params)==1 and get_E_value(params) == 13652.6:
-                # print("line ",line)
-
-                if self.brush_on_canvas == True:
-                    # if len(line.block.modal_params)==0:
-                    #     # print("skip drawing this move")
-                    #     continue
-                    if self.move_to_other_shape == True:
-                        self.move_to_other_shape = False
-                        self.last_draw_params = params
-                        self.last_draw_gcode = gcode
-                        self.gcodes.append(GCodeLinearMove(X=float(x + self.offset_x), Y=float(y + self.offset_y)))
-                        self.gcodes.append(self.brush_on_canvas_gcode)
-                        set_normal_speed()
-                        continue
-                    # G92 E0
-
-                    if self.extruding == True:
-                        self.extruding = False
-                        self.last_draw_params = params
-                        self.last_draw_gcode = gcode
-                        self.gcodes.append(GCodeLinearMove(X=float(x + self.offset_x), Y=float(y + self.offset_y)))
-                        self.gcodes.append(self.brush_on_canvas_gcode)
-                        set_normal_speed()
-                        continue
-
+                dist = 0
+                if self.last_draw_point is not None:
+                    # print("calculate dist")
+                    prev_x, prev_y = self.last_draw_point
+                    dist = calculate_dist(prev_x, prev_y, x, y)
+                    counts["painted_mm"] += dist
+
+                ################################
+                # what if line is longer then than self.paint_per_run
+                ################################
+                if self.paint_plan is not None:
+                    append_planned_segment(dist, prev_x, prev_y, x, y)
                     dist = 0
-                    if self.last_draw_gcode is not None:
-                        # print("calculate dist")
-                        prev_x = self.last_draw_gcode.X
-                        prev_y = self.last_draw_gcode.Y
-                        dist = calculate_dist(prev_x, prev_y, x, y)
-
-                    ################################
-                    # what if line is longer then than self.paint_per_run
-                    ################################
-                    if dist > self.paint_per_run:
-                        dist = append_intermediate_points(dist, prev_x, prev_y, x, y)
-                        self.randomize_paint_per_run()
-                    else:
-                        self.gcodes.append(GCodeLinearMove(X=float(x + self.offset_x), Y=float(y + self.offset_y)))
+                elif dist > self.paint_per_run:
+                    dist = append_intermediate_points(dist, prev_x, prev_y, x, y)
+                    self.randomize_paint_per_run()
+                else:
+                    self.gcodes.linear(X=float(x + self.offset_x), Y=float(y + self.offset_y))
 
-                    append_dist_painted(dist)
+                append_dist_painted(dist)
 
-                    if self.dist_painted > self.paint_per_run:
-                        # print("go for paint")
-                        append_go_for_paint(x, y)
-                        self.randomize_paint_per_run()
+                if self.paint_plan is None and self.dist_painted > self.paint_per_run:
+                    # print("go for paint")
+                    append_go_for_paint(x, y)
+                    self.randomize_paint_per_run()
 
-                    self.last_draw_gcode = gcode
-                    self.last_draw_params = params
+                self.last_draw_point = point
 
-                if self.brush_on_canvas == False:
-                    self.gcodes.append(GCodeLinearMove(X=float(x + self.offset_x), Y=float(y + self.offset_y)))
-                    # print("continue")
-                    continue
+            if self.brush_on_canvas == False:
+                self.gcodes.linear(X=float(x + self.offset_x), Y=float(y + self.offset_y))
+                # print("continue")
+                continue
 
-                # print("came here")
+            # print("came here")
 
-                counter += 1
-                # if counter>5:
-                #     break
+            counter += 1
+            # if counter>5:
+            #     break
+
+        parse_time = time.perf_counter() - parse_start
+        print(f"Parsed {gcode_path}: {lines_read} lines in {parse_time:.2f}s ({lines_read / max(parse_time, 1e-9):.0f} lines/s)")
 
         if self.move_to_other_shape_lift + self.canvas_height > self.go_in_tray_lift:
-            self.gcodes.append(GCodeRapidMove(Z=self.move_to_other_shape_lift + self.canvas_height))
+            self.gcodes.rapid(Z=self.move_to_other_shape_lift + self.canvas_height)
         else:
-            self.gcodes.append(GCodeRapidMove(Z=self.go_in_tray_lift))
+            self.gcodes.rapid(Z=self.go_in_tray_lift)
         # self.gcodes.append(GCodeRapidMove(
         #     z=self.move_to_other_shape_lift+self.canvas_height))
-        self.gcodes.append(GCodeRapidMove(X=0, Y=0))
+        self.gcodes.rapid(X=0, Y=0)
 
         wash_the_brush(0, 0)
 
@@ -455,11 +508,16 @@ class Copicograf:
         ###########################
         set_fast_speed()
         if self.move_to_other_shape_lift + self.canvas_height > self.go_in_tray_lift:
-            self.gcodes.append(GCodeRapidMove(Z=self.move_to_other_shape_lift + self.canvas_height))
+            self.gcodes.rapid(Z=self.move_to_other_shape_lift + self.canvas_height)
         else:
-            self.gcodes.append(GCodeRapidMove(Z=self.go_in_tray_lift))
+            self.gcodes.rapid(Z=self.go_in_tray_lift)
         # self.gcodes.append(GCodeRapidMove(
         #     Z=self.move_to_other_shape_lift+self.canvas_height))
-        self.gcodes.append(GCodeRapidMove(X=self.water_tray_x, Y=self.water_tray_y))
-        self.gcodes.append(GCodeRapidMove(Z=0))
+        self.gcodes.rapid(X=self.water_tray_x, Y=self.water_tray_y)
+        self.gcodes.rapid(Z=0)
         set_normal_speed()
+
+        self.stats.add(
+            "copicograf:prepare_path", time.perf_counter() - start_time,
+            lines_read=lines_read, moves=self.gcodes.lines - start_lines, bytes=self.gcodes.bytes - start_bytes, **counts,
+        )
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+import heapq
+import itertools
+import os
+import queue
+import random
+import select
+import threading
+import time
+import tty
+
+from gcode_sender import checksum
+
+
+class FakeFirmware:
+    """Marlin-like firmware on a pseudo terminal, for running the sender without a machine.
+
+    Bytes arrive in an RX ring of rx_buffer bytes; what does not fit is dropped, as the serial interrupt would.
+    Lines move from there into a planner queue of planner commands as long as it has room, and each is acknowledged
+    with "ok" latency seconds later (the USB round trip). Moves take move_time seconds to execute; the time the planner
+    sits empty between commands is counted as starvation. Line numbers and checksums are checked like Marlin does,
+    answering a bad line with Error, "Resend: N" and ok. error_rate corrupts that share of the received lines.
+    """
+
+    def __init__(self, rx_buffer=128, planner=16, move_time=0.002, latency=0.001, error_rate=0.0, seed=0):
+        self.rx_buffer = rx_buffer
+        self.move_time = move_time
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._planner = queue.Queue(maxsize=planner)
+        self._responses = []
+        self._order = itertools.count()
+        self._last_line = 0
+        self._running = False
+        self._threads = []
+        self.stats = {"lines": 0, "executed": 0, "errors": 0, "injected_errors": 0, "rx_overflow_bytes": 0, "starved": 0, "starved_s": 0.0}
+
+    def start(self):
+        """Open the pseudo terminal and start the firmware. Returns the device path to connect to."""
+        self._master, self._slave = os.openpty()
+        # Raw mode, so the terminal neither echoes the lines back nor translates line ends
+        tty.setraw(self._slave)
+        self._running = True
+        self._respond("start")
+        self._threads = [threading.Thread(target=self._serial_loop, daemon=True), threading.Thread(target=self._planner_loop, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        return os.ttyname(self._slave)
+
+    def stop(self):
+        self._running = False
+        for thread in self._threads:
+            thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _respond(self, text, delay=0.0):
+        heapq.heappush(self._responses, (time.perf_counter() + delay, next(self._order), text))
+
+    def _serial_loop(self):
+        rx = bytearray()
+        while self._running:
+            timeout = 0.001 if self._responses else 0.01
+            readable, _, _ = select.select([self._master], [], [], timeout)
+            if readable:
+                try:
+                    data = os.read(self._master, 4096)
+                except OSError:
+                    data = b""
+                room = self.rx_buffer - len(rx)
+                if len(data) > room:
+                    self.stats["rx_overflow_bytes"] += len(data) - room
+                    data = data[: max(room, 0)]
+                rx += data
+            while b"\n" in rx and not self._planner.full():
+                line, _, rest = bytes(rx).partition(b"\n")
+                rx[:] = rest
+                self._receive(line.decode(errors="replace").strip())
+            now = time.perf_counter()
+            while self._responses and self._responses[0][0] <= now:
+                _, _, text = heapq.heappop(self._responses)
+                os.write(self._master, f"{text}\n".encode())
+
+    def _receive(self, line):
+        if not line:
+            return
+        self.stats["lines"] += 1
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.stats["injected_errors"] += 1
+            line = line[:-1] + ("0" if line[-1] != "0" else "1")
+        command = line
+        if line.startswith("N"):
+            text, _, cs = line.rpartition("*")
+            number, _, command = text.partition(" ")
+            try:
+                n, valid = int(number[1:]), cs.isdigit() and int(cs) == checksum(text)
+            except ValueError:
+                n, valid = None, False
+            if not valid:
+                return self._error(f"checksum mismatch, Last Line: {self._last_line}")
+            if command.startswith("M110"):
+                # M110 sets the line number: to its N parameter, else to the line's own number
+                words = command.split()
+                n = int(words[1][1:]) if len(words) > 1 and words[1].startswith("N") else n
+            elif n != self._last_line + 1:
+                return self._error(f"Line Number is not Last Line Number+1, Last Line: {self._last_line}")
+            self._last_line = n
+        self._planner.put_nowait(command)
+        self._respond("ok", self.latency)
+
+    def _error(self, message):
+        self.stats["errors"] += 1
+        self._respond(f"Error:{message}")
+        self._respond(f"Resend: {self._last_line + 1}")
+        self._respond("ok", self.latency)
+
+    def _planner_loop(self):
+        idle_since = None
+        while self._running:
+            try:
+                command = self._planner.get(timeout=0.05)
+            except queue.Empty:
+                if idle_since is None and self.stats["executed"]:
+                    idle_since = time.perf_counter() - 0.05
+                continue
+            if idle_since is not None:
+                self.stats["starved"] += 1
+                self.stats["starved_s"] += time.perf_counter() - idle_since
+                idle_since = None
+            if command.startswith(("G0", "G1")):
+                time.sleep(self.move_time)
+            self.stats["executed"] += 1
+            if self._planner.empty():
+                idle_since = time.perf_counter()
+
+
+def main():
+    import argparse
+
+    argparser = argparse.ArgumentParser(description="Marlin-like firmware on a pseudo terminal")
+    argparser.add_argument("--rx-buffer", dest="rx_buffer", default=128, help="RX buffer size in bytes", type=int)
+    argparser.add_argument("--planner", dest="planner", default=16, help="Planner queue length in commands", type=int)
+    argparser.add_argument("--move-time", dest="move_time", default=0.002, help="Execution time of a G0/G1 move in s", type=float)
+    argparser.add_argument("--latency", dest="latency", default=0.001, help="Delay of each ok in s", type=float)
+    argparser.add_argument("--error-rate", dest="error_rate", default=0.0, help="Share of received lines to corrupt", type=float)
+    args = argparser.parse_args()
+
+    firmware = FakeFirmware(args.rx_buffer, args.planner, args.move_time, args.latency, args.error_rate)
+    print(f"Fake firmware on {firmware.start()}, Ctrl-C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    firmware.stop()
+    print(firmware.stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+import time
+
+import cv2
+import numpy as np
+
+from gcode_reader import open_gcode
+
+PATTERNS = ("concentric", "lines")
+
+
+def rasterize_polygons(polygons, scale_x, scale_y, resolution=0.05):
+    """Fill polygons (pixel units, y down) even-odd into a mask of resolution mm cells, scaled by scale_x/scale_y mm per pixel.
+
+    Returns the mask and the position of its cell (0, 0) in mm.
+    """
+    scaled = [np.asarray(polygon, dtype=np.float64) * (scale_x, scale_y) for polygon in polygons if len(polygon) > 2]
+    if not scaled:
+        return np.zeros((1, 1), dtype=bool), (0.0, 0.0)
+    low = np.min([polygon.min(axis=0) for polygon in scaled], axis=0) - 2 * resolution
+    high = np.max([polygon.max(axis=0) for polygon in scaled], axis=0) + 2 * resolution
+    width, height = np.ceil((high - low) / resolution).astype(int) + 1
+    mask = np.zeros((height, width), dtype=np.uint8)
+    # 4 fractional bits keep the vertices at sub-cell precision
+    cv2.fillPoly(mask, [np.round((polygon - low) / resolution * 16).astype(np.int32) for polygon in scaled], 1, cv2.LINE_8, 4)
+    return mask.astype(bool), tuple(low)
+
+
+def _contour_paths(level, epsilon):
+    contours, _ = cv2.findContours(level.astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+    paths = []
+    for contour in contours:
+        points = cv2.approxPolyDP(contour, epsilon, True).reshape(-1, 2)
+        if len(points) > 1:
+            # Closed loops end where they start
+            paths.append(np.vstack([points, points[:1]]))
+        else:
+            paths.append(points)
+    return paths
+
+
+def concentric_paths(mask, resolution, line_distance, epsilon=0.5):
+    """Loops at line_distance / 2, 3 * line_distance / 2, ... inside the shapes: offsets of the outline, as iso-lines of its distance transform."""
+    distance = cv2.distanceTransform(np.pad(mask, 1).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)[1:-1, 1:-1] * resolution
+    paths = []
+    offset = line_distance / 2
+    while (distance > offset).any():
+        paths += _contour_paths(distance > offset, epsilon)
+        offset += line_distance
+    return paths
+
+
+def line_paths(mask, resolution, line_distance, epsilon=0.5):
+    """An outline at line_distance / 2 inside the shapes, then parallel lines along X every line_distance, clipped to
+    line_distance inside the outline and drawn back and forth."""
+    distance = cv2.distanceTransform(np.pad(mask, 1).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)[1:-1, 1:-1] * resolution
+    paths = _contour_paths(distance > line_distance / 2, epsilon)
+    inner = distance > line_distance
+    step = max(line_distance / resolution, 1)
+    for n, row in enumerate(np.arange(step / 2, inner.shape[0], step).astype(int)):
+        edges = np.diff(np.concatenate([[0], inner[row].astype(np.int8), [0]]))
+        starts, stops = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1
+        runs = list(zip(starts, stops))
+        for start, stop in reversed(runs) if n % 2 else runs:
+            ends = [(start, row), (stop, row)]
+            paths.append(np.array(ends[::-1] if n % 2 else ends))
+    return paths
+
+
+def fill_mask(mask, origin, resolution, line_distance, pattern="concentric"):
+    """Fill paths of a mask in mm, y up, centred on the origin like a slicer with machine_center_is_zero."""
+    paths = (concentric_paths if pattern == "concentric" else line_paths)(mask, resolution, line_distance)
+    rows, columns = np.nonzero(mask)
+    if not len(rows):
+        return []
+    # Cell centres to mm, flipping y, then centre the bounding box of the shapes
+    center = (origin[0] + (columns.min() + columns.max() + 1) / 2 * resolution, origin[1] + (rows.min() + rows.max() + 1) / 2 * resolution)
+    return [np.column_stack([origin[0] + (path[:, 0] + 0.5) * resolution - center[0], center[1] - origin[1] - (path[:, 1] + 0.5) * resolution]) for path in paths]
+
+
+def write_gcode(paths, result_file):
+    """Write paths in the dialect Copicograf.prepare_path reads: pen up (Z6), travel, pen down (Z1), then the points."""
+    with open_gcode(result_file, "w") as fh:
+        fh.write(";FLAVOR:Marlin\n")
+        for path in paths:
+            fh.write("G1 F600 Z6\n")
+            fh.write(f"G0 X{path[0][0]:.3f} Y{path[0][1]:.3f}\n")
+            fh.write("G1 F600 Z1\n")
+            # prepare_path lowers the brush at the first point after Z1, so the start is repeated to paint the whole path
+            for x, y in path:
+                fh.write(f"G1 X{x:.3f} Y{y:.3f}\n")
+        fh.write("G1 F600 Z6\n")
+
+
+def fill_polygons(polygons, result_file, scale_x, scale_y, line_distance=1.0, pattern="concentric", resolution=0.05):
+    """Write concentric or line fill G-code for traced polygons, in place of OpenSCAD and the slicer."""
+    start_time = time.perf_counter()
+    mask, origin = rasterize_polygons(polygons, scale_x, scale_y, resolution)
+    paths = fill_mask(mask, origin, resolution, line_distance, pattern)
+    write_gcode(paths, result_file)
+    print(f"Filled {result_file} ({pattern}, {line_distance}mm): {len(paths)} paths, {sum(len(path) for path in paths)} points in {time.perf_counter() - start_time:.2f}s")
+    return paths
+
+
+def main():
+    import argparse
+
+    from contour_trace import read_mask, trace_contours
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-i", "--input", dest="input", default=None, help="Input level image (i2gc preview PNG)", type=str, required=True)
+    argparser.add_argument("-o", "--output", dest="output", default=None, help="Output gcode", type=str, required=True)
+    argparser.add_argument("-X", "--width", dest="width", default=None, help="Output width in mm", type=float, required=True)
+    argparser.add_argument("-Y", "--height", dest="height", default=None, help="Output height in mm", type=float, required=True)
+    argparser.add_argument("-d", "--line_distance", dest="line_distance", default=1.0, help="Distance between fill lines in mm", type=float)
+    argparser.add_argument("-p", "--pattern", dest="pattern", default="concentric", choices=PATTERNS, help="Fill pattern", type=str)
+    argparser.add_argument("-r", "--resolution", dest="resolution", default=0.05, help="Raster resolution for offsetting in mm", type=float)
+    args = argparser.parse_args()
+
+    mask = read_mask(args.input)
+    fill_polygons(trace_contours(mask), args.output, args.width / mask.shape[1], args.height / mask.shape[0], args.line_distance, args.pattern, args.resolution)
+
+
+if __name__ == "__main__":
+    main()
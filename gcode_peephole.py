@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+from gcode_reader import open_gcode, read_gcode, tokenize
+
+# Modal commands the pass tracks, by the words they set
+_MODAL = {
+    "acc": ("M", 204.0),
+    "max": ("M", 203.0),
+}
+
+
+def _word(letter, value):
+    return f"{letter}{value:g}"
+
+
+def _modal_words(kind, words):
+    """The words a modal line sets. M204 S sets the printing and travel acceleration both, so it is taken as P and T."""
+    letter, _ = _MODAL[kind]
+    words = {k: v for k, v in words.items() if k != letter}
+    if kind == "acc" and "S" in words:
+        acc = words.pop("S")
+        words = {"P": acc, "T": acc, **words}
+    return words
+
+
+class Peephole:
+    """Streaming pass that drops G-code lines which change nothing and merges runs of mode switches.
+
+    It tracks feed rate, acceleration (M204), maximum rates (M203), absolute/relative positioning (G90/G91), relative
+    extrusion (M82/M83) and the X/Y/Z position. Modal changes are held back until the next line that moves or otherwise
+    acts, then only those that still differ from what the machine already has are written, so "set fast speed; set
+    normal speed" with nothing in between leaves only the normal speed lines. Moves to where the tool already is, with
+    no extrusion, are dropped. Streams are taken to start in absolute positioning, Marlin's default, until a G91.
+    """
+
+    def __init__(self, emit):
+        self._emit = emit
+        self.lines_in = 0
+        self.lines_out = 0
+        # What the machine has been sent, and what it will have once the held back lines are written
+        self._sent = {"acc": {}, "max": {}, "feed": None, "absolute": None, "relative_e": None}
+        self._state = {"acc": {}, "max": {}, "feed": None, "absolute": True, "relative_e": None}
+        self._pending = {}
+        self._position = {"X": None, "Y": None, "Z": None}
+
+    def _write(self, text):
+        self._emit(text)
+        self.lines_out += 1
+
+    def _hold(self, kind, text, value):
+        self._state[kind] = value
+        # Re-insert so pending lines keep the order of their last occurrence
+        self._pending.pop(kind, None)
+        self._pending[kind] = (text, value)
+
+    def flush(self):
+        for kind, (text, value) in self._pending.items():
+            if value == self._sent[kind]:
+                continue
+            if kind in _MODAL:
+                letter, number = _MODAL[kind]
+                if {**self._sent[kind], **_modal_words(kind, tokenize(text)[1])} != value:
+                    # The last line alone would not reach the merged state, so write the changed words explicitly
+                    text = " ".join([_word(letter, number)] + [_word(k, v) for k, v in value.items() if self._sent[kind].get(k) != v])
+            self._write(text)
+            self._sent[kind] = value
+        self._pending = {}
+
+    def _is_noop_move(self, words):
+        if "E" in words:
+            return False
+        for axis in "XYZ":
+            if axis not in words:
+                continue
+            current = self._position[axis]
+            if self._state["absolute"] is False:
+                if words[axis] != 0:
+                    return False
+            elif current is None or current != words[axis]:
+                return False
+        return True
+
+    def _move_position(self, words):
+        for axis in "XYZ":
+            if axis not in words:
+                continue
+            if self._state["absolute"] is False:
+                current = self._position[axis]
+                self._position[axis] = None if current is None else current + words[axis]
+            else:
+                self._position[axis] = words[axis]
+
+    def line(self, text):
+        self.lines_in += 1
+        line = tokenize(text)
+        if line is None:
+            self.flush()
+            self._write(text)
+            return
+        gcodes, words, comment = line
+        motion = 0.0 in gcodes or 1.0 in gcodes
+        axes = any(axis in words for axis in "XYZE")
+        if not comment and "M" in words and not gcodes:
+            for kind, (letter, number) in _MODAL.items():
+                if words["M"] == number:
+                    self._hold(kind, text, {**self._state[kind], **_modal_words(kind, words)})
+                    return
+            if words["M"] in (82.0, 83.0) and len(words) == 1:
+                self._hold("relative_e", text, words["M"] == 83.0)
+                return
+        if gcodes in ((90.0,), (91.0,)) and not words:
+            # Held with its comment, "G90 ; sets absolute positioning" is written as is
+            self._hold("absolute", text, gcodes == (90.0,))
+            return
+        if not comment and "F" in words and not axes and set(words) == {"F"} and (not gcodes or (motion and len(gcodes) == 1)):
+            # Feed rate only, "F2000" or "G0 F1000"
+            self._hold("feed", text, words["F"])
+            return
+        if motion and axes and len(gcodes) == 1 and not comment and "F" not in words and self._is_noop_move(words):
+            return
+        self.flush()
+        self._write(text)
+        if motion and "F" in words:
+            self._state["feed"] = self._sent["feed"] = words["F"]
+        if 28.0 in gcodes:
+            self._position = {"X": None, "Y": None, "Z": None}
+        elif 92.0 in gcodes:
+            self._position.update({axis: words[axis] for axis in "XYZ" if axis in words})
+        elif motion:
+            self._move_position(words)
+
+    def report(self):
+        removed = self.lines_in - self.lines_out
+        return f"{self.lines_in} -> {self.lines_out} lines ({removed} removed, {100 * removed / max(self.lines_in, 1):.1f}%)"
+
+
+def optimize(gcode_path, result_file):
+    """Run the peephole pass over a whole file, streaming it line by line."""
+    with open_gcode(gcode_path) as fh, open_gcode(result_file, "w") as out:
+        sep = [""]
+
+        def emit(text):
+            out.write(sep[0])
+            out.write(text)
+            sep[0] = "\n"
+
+        peephole = Peephole(emit)
+        for text in fh:
+            peephole.line(text.rstrip("\n"))
+        peephole.flush()
+    return peephole
+
+
+def repeated_moves(gcode_path):
+    """Count the moves, without extrusion, to where the tool already is: what the pass should leave none of."""
+    position, absolute, count = {}, True, 0
+    for gcodes, words, _ in read_gcode(gcode_path):
+        if gcodes in ((90.0,), (91.0,)):
+            absolute = gcodes == (90.0,)
+        elif 28.0 in gcodes:
+            position = {}
+        elif 92.0 in gcodes or ((0.0 in gcodes or 1.0 in gcodes) and absolute):
+            axes = {axis: words[axis] for axis in "XYZ" if axis in words}
+            if 92.0 not in gcodes and axes and "E" not in words and all(position.get(axis) == value for axis, value in axes.items()):
+                count += 1
+            position.update(axes)
+    return count
+
+
+def main():
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-i", "--input", dest="input", default=None, help="Input gcode", type=str, required=True)
+    argparser.add_argument("-o", "--output", dest="output", default=None, help="Output gcode", type=str, required=True)
+    args = argparser.parse_args()
+
+    peephole = optimize(args.input, args.output)
+    print(f"Peephole: {peephole.report()}, {repeated_moves(args.output)} repeated moves left")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+import os
+import queue
+import select
+import termios
+import threading
+import time
+import tty
+from collections import OrderedDict, deque
+
+from gcode_reader import open_gcode
+
+PROTOCOLS = ("chars", "ok")
+
+
+class SenderError(RuntimeError):
+    pass
+
+
+def checksum(text):
+    """Marlin's line checksum: the XOR of the bytes before the "*"."""
+    cs = 0
+    for byte in text.encode():
+        cs ^= byte
+    return cs
+
+
+def read_commands(gcode_path):
+    """Lines of a G-code file as sent to the machine, read lazily: comments and blank lines dropped."""
+    with open_gcode(gcode_path) as fh:
+        for line in fh:
+            command = line.split(";", 1)[0].strip()
+            if command:
+                yield command
+
+
+def open_port(port, baud=115200):
+    """Open a serial port (or pseudo terminal) raw, at baud, without becoming its controlling terminal."""
+    fd = os.open(port, os.O_RDWR | os.O_NOCTTY)
+    tty.setraw(fd)
+    speed = getattr(termios, f"B{baud}", None)
+    if speed is None:
+        os.close(fd)
+        raise SenderError(f"Unsupported baud rate {baud}")
+    attributes = termios.tcgetattr(fd)
+    attributes[4] = attributes[5] = speed
+    termios.tcsetattr(fd, termios.TCSANOW, attributes)
+    return fd
+
+
+class SenderStats:
+    def __init__(self):
+        self.lines = 0
+        self.bytes = 0
+        self.resends = 0
+        self.errors = 0
+        self.window_waits = 0
+        self.max_in_flight = 0
+        self.ok_latency_total = 0.0
+        self.ok_latency_max = 0.0
+        self.acknowledged = 0
+        self.elapsed = 0.0
+
+    def report(self):
+        return {
+            "lines": self.lines,
+            "bytes": self.bytes,
+            "resends": self.resends,
+            "errors": self.errors,
+            "window_waits": self.window_waits,
+            "max_in_flight": self.max_in_flight,
+            "ok_latency_avg_ms": 1000 * self.ok_latency_total / max(self.acknowledged, 1),
+            "ok_latency_max_ms": 1000 * self.ok_latency_max,
+            "elapsed_s": self.elapsed,
+            "lines_per_s": self.lines / max(self.elapsed, 1e-9),
+            "bytes_per_s": self.bytes / max(self.elapsed, 1e-9),
+        }
+
+    def __str__(self):
+        report = self.report()
+        return (
+            f"{report['lines']} lines, {report['bytes']} bytes in {report['elapsed_s']:.1f}s "
+            f"({report['lines_per_s']:.0f} lines/s, {report['bytes_per_s'] / 1024:.1f}KB/s), {report['resends']} resends, "
+            f"{report['errors']} errors, up to {report['max_in_flight']} in flight, "
+            f"ok latency {report['ok_latency_avg_ms']:.1f}ms avg {report['ok_latency_max_ms']:.1f}ms max"
+        )
+
+
+class GCodeSender:
+    """Stream G-code to Marlin with several commands in flight instead of waiting for every "ok".
+
+    Lines go out numbered and checksummed ("N12 G1 X1*87"). With the "chars" protocol a line is sent while the bytes
+    in flight fit the firmware's RX buffer (rx_buffer); with "ok" while fewer than window lines wait for their ok. A
+    "Resend: N" rewinds to line N from the sent lines kept in history; the Resends the firmware repeats for the lines
+    that were already in flight behind the bad one are ignored.
+    """
+
+    def __init__(self, port, baud=115200, protocol="chars", window=4, rx_buffer=127, timeout=30.0, history=1024, verbose=False):
+        if protocol not in PROTOCOLS:
+            raise ValueError(f"Unknown protocol: {protocol}")
+        self.protocol = protocol
+        self.window = window
+        self.rx_buffer = rx_buffer
+        self.timeout = timeout
+        self.history_size = history
+        self.verbose = verbose
+        self.stats = SenderStats()
+        self._fd = open_port(port, baud)
+        self._responses = queue.Queue()
+        self._running = True
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def close(self):
+        self._running = False
+        self._reader.join()
+        os.close(self._fd)
+
+    def _read_loop(self):
+        buffer = b""
+        while self._running:
+            readable, _, _ = select.select([self._fd], [], [], 0.05)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._fd, 4096)
+            except OSError:
+                break
+            buffer += data
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                self._responses.put(line.decode(errors="replace").strip())
+
+    def _write(self, data):
+        while data:
+            data = data[os.write(self._fd, data) :]
+
+    def wait_for_start(self, wait=2.0):
+        """Wait up to wait seconds for the "start" a board prints when opening the port resets it."""
+        deadline = time.perf_counter() + wait
+        while time.perf_counter() < deadline:
+            try:
+                if self._responses.get(timeout=deadline - time.perf_counter()).startswith("start"):
+                    return True
+            except queue.Empty:
+                break
+        return False
+
+    def stream(self, commands):
+        """Send the commands (an iterable of lines without line ends) and wait for all of them to be acknowledged."""
+        start_time = time.perf_counter()
+        commands = iter(commands)
+        history = OrderedDict()
+        # (line number, bytes, send time, epoch) of the lines waiting for their ok
+        in_flight = deque()
+        in_flight_bytes = 0
+        # Line numbers: the next new one, and the next to send, which is behind it after a Resend
+        line, cursor = 1, 0
+        epoch, last_resend = 0, None
+        history[0] = "M110 N0"
+        exhausted = False
+        frame = None
+        while True:
+            # Send while the window has room
+            while True:
+                if frame is None:
+                    if cursor == line:
+                        if exhausted:
+                            break
+                        try:
+                            history[line] = next(commands)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        line += 1
+                        while len(history) > self.history_size:
+                            history.popitem(last=False)
+                    text = f"N{cursor} {history[cursor]}"
+                    frame = (cursor, f"{text}*{checksum(text)}\n".encode())
+                n, data = frame
+                if in_flight and (len(data) + in_flight_bytes > self.rx_buffer if self.protocol == "chars" else len(in_flight) >= self.window):
+                    self.stats.window_waits += 1
+                    break
+                self._write(data)
+                in_flight.append((n, len(data), time.perf_counter(), epoch))
+                in_flight_bytes += len(data)
+                self.stats.lines += 1
+                self.stats.bytes += len(data)
+                self.stats.max_in_flight = max(self.stats.max_in_flight, len(in_flight))
+                cursor += 1
+                frame = None
+            if not in_flight:
+                break
+            try:
+                response = self._responses.get(timeout=self.timeout)
+            except queue.Empty:
+                raise SenderError(f"No response for {self.timeout}s with {len(in_flight)} lines in flight, from line {in_flight[0][0]}")
+            if self.verbose and not response.startswith("ok"):
+                print(f"< {response}")
+            if response.startswith("ok"):
+                if in_flight:
+                    _, size, sent, _ = in_flight.popleft()
+                    in_flight_bytes -= size
+                    latency = time.perf_counter() - sent
+                    self.stats.acknowledged += 1
+                    self.stats.ok_latency_total += latency
+                    self.stats.ok_latency_max = max(self.stats.ok_latency_max, latency)
+            elif response.startswith(("Resend:", "rs ")):
+                n = int(response.replace(":", " ").split()[1])
+                # Lines sent before the last rewind get the same Resend again, as the firmware rejects them too
+                if n == last_resend and in_flight and in_flight[0][3] < epoch:
+                    continue
+                if n not in history:
+                    raise SenderError(f"Resend of line {n}, which is no longer in the history")
+                self.stats.resends += 1
+                epoch, last_resend = epoch + 1, n
+                cursor, frame = n, None
+            elif response.startswith("Error:"):
+                self.stats.errors += 1
+                if "halted" in response or "kill" in response.lower():
+                    raise SenderError(f"Firmware stopped: {response}")
+            elif response.startswith("!!"):
+                raise SenderError(f"Firmware stopped: {response}")
+        self.stats.elapsed = time.perf_counter() - start_time
+        return self.stats
+
+
+def send_gcode(gcode_path, port, baud=115200, protocol="chars", window=4, rx_buffer=127, timeout=30.0, verbose=False):
+    """Stream a G-code file to the machine on port. Returns the SenderStats."""
+    sender = GCodeSender(port, baud, protocol, window, rx_buffer, timeout, verbose=verbose)
+    try:
+        sender.wait_for_start()
+        stats = sender.stream(read_commands(gcode_path))
+    finally:
+        sender.close()
+    print(f"Sent {gcode_path}: {stats}")
+    return stats
+
+
+def main():
+    import argparse
+    import json
+
+    argparser = argparse.ArgumentParser(description="Stream G-code to a Marlin machine")
+    argparser.add_argument("-i", "--input", dest="input", default=None, help="Input gcode", type=str, required=True)
+    argparser.add_argument("-p", "--port", dest="port", default=None, help="Serial port, e.g. /dev/ttyUSB0", type=str)
+    argparser.add_argument("-b", "--baud", dest="baud", default=115200, help="Baud rate", type=int)
+    argparser.add_argument("--protocol", dest="protocol", default="chars", choices=PROTOCOLS, help="Flow control: fill the RX buffer (chars) or a number of lines (ok)", type=str)
+    argparser.add_argument("-w", "--window", dest="window", default=4, help="Lines in flight with the ok protocol", type=int)
+    argparser.add_argument("--rx-buffer", dest="rx_buffer", default=127, help="Firmware RX buffer in bytes for the chars protocol", type=int)
+    argparser.add_argument("-t", "--timeout", dest="timeout", default=30.0, help="Seconds without a response before giving up", type=float)
+    argparser.add_argument("--simulate", dest="simulate", action="store_true", help="Send to a simulated firmware (fake_firmware) instead of --port")
+    argparser.add_argument("--error-rate", dest="error_rate", default=0.0, help="Share of lines the simulated firmware corrupts", type=float)
+    argparser.add_argument("--sim-latency", dest="sim_latency", default=0.001, help="Delay of the simulated firmware's oks in s", type=float)
+    argparser.add_argument("--sim-move-time", dest="sim_move_time", default=0.002, help="Execution time of a move in the simulated firmware in s", type=float)
+    argparser.add_argument("--json", dest="json", action="store_true", help="Print the stats as JSON")
+    argparser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Print the firmware's responses other than ok")
+    args = argparser.parse_args()
+
+    firmware = None
+    if args.simulate:
+        from fake_firmware import FakeFirmware
+
+        firmware = FakeFirmware(rx_buffer=args.rx_buffer + 1, move_time=args.sim_move_time, latency=args.sim_latency, error_rate=args.error_rate)
+        args.port = firmware.start()
+    elif not args.port:
+        argparser.error("--port is required unless --simulate is given")
+    try:
+        stats = send_gcode(args.input, args.port, args.baud, args.protocol, args.window, args.rx_buffer, args.timeout, args.verbose)
+    finally:
+        if firmware:
+            firmware.stop()
+            print(f"Simulated firmware: {firmware.stats}")
+    if args.json:
+        print(json.dumps(stats.report(), indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+from gcode_peephole import Peephole
+
+
+def _word(letter, value):
+    # Same text as pygcode's CLEAN_FLOAT: "{0:g}" of the value rounded to 3 decimals
+    return f" {letter}{round(float(value), 3):g}"
+
+
+class GCodeWriter:
+    """Stream G-code lines into an open file, formatted exactly like str() of the pygcode moves."""
+
+    def __init__(self, fh, fast=False, peephole=False):
+        self._fh = fh
+        self._move = "G00" if fast else "G01"
+        self._sep = ""
+        self.lines = 0
+        # Characters written, the size of the G-code before any compression
+        self.bytes = 0
+        # Optional pass dropping lines that change nothing, see gcode_peephole
+        self.peephole = Peephole(self._write) if peephole else None
+
+    def _write(self, text):
+        self._fh.write(self._sep)
+        self._fh.write(text)
+        self.bytes += len(self._sep) + len(text)
+        self._sep = "\n"
+        self.lines += 1
+
+    def raw(self, text):
+        """Write one line as is. Lines are newline separated, without a trailing newline, like "\\n".join()."""
+        if self.peephole:
+            self.peephole.line(text)
+        else:
+            self._write(text)
+
+    def flush(self):
+        """Write the mode switches the peephole pass still holds back. Call before closing the file."""
+        if self.peephole:
+            self.peephole.flush()
+
+    def _words(self, X, Y, Z, E):
+        text = ""
+        if X is not None:
+            text += _word("X", X)
+        if Y is not None:
+            text += _word("Y", Y)
+        if Z is not None:
+            text += _word("Z", Z)
+        if E is not None:
+            # E values were always appended to the stringified move, so they keep Python's float formatting
+            text += f" E{E}"
+        return text
+
+    def feed_rate(self, F):
+        self.raw(f"F{round(float(F), 3):g}")
+
+    def rapid(self, X=None, Y=None, Z=None, E=None):
+        """G00 move, pygcode's GCodeRapidMove."""
+        self.raw("G00" + self._words(X, Y, Z, E))
+
+    def linear(self, X=None, Y=None, Z=None, E=None):
+        """G01 move, pygcode's GCodeLinearMove."""
+        self.raw("G01" + self._words(X, Y, Z, E))
+
+    def move(self, X=None, Y=None, Z=None, E=None):
+        """Drawing move: G00 when the writer is fast, G01 otherwise."""
+        self.raw(self._move + self._words(X, Y, Z, E))
@@ -1,14 +1,21 @@
 #!/usr/bin/python3
-from os.path import isfile, splitext
-from concurrent.futures import ThreadPoolExecutor as PoolExecutor
-from functools import partial
+import os
+from os.path import dirname, isfile, join, splitext
+from concurrent.futures import ThreadPoolExecutor as PoolExecutor, ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import shutil
+import tempfile
 from datetime import datetime
 import math
+import time
 
-from PIL import Image, ImageCms, ImageColor
-from pygcode import *
+from PIL import Image, ImageColor
 import numpy as np
 
+import color_transform
+from gcode_reader import COMPRESSIONS, compressed_path, open_gcode
+from gcode_writer import GCodeWriter
+from stage_stats import StageStats
 from utils import color_profile_dir
 
 
@@ -31,6 +38,16 @@ class I2GC:
         join: bool = False,
         grayscale: bool = False,
         custom_colors: list[str] | None = None,
+        engine: str = "numpy",
+        pool: str = "thread",
+        workers: int | None = None,
+        preview_scale: float = 1,
+        icc_cache: str | None = None,
+        peephole: bool = False,
+        tile_rows: int | None = None,
+        tile_dir: str | None = None,
+        stats: StageStats | None = None,
+        compression: str | None = None,
     ):
         self._img_file = img_file
         if not self._img_file or not isfile(self._img_file):
@@ -48,12 +65,26 @@ class I2GC:
         self._profile = profile
         self._grayscale = grayscale
         self._fast = fast
-        self.GCodeMove = GCodeRapidMove if self._fast else GCodeLinearMove
         self._join = join
         self._temperature = temperature
         self._e_speed = extruder_speed
         self._retract = retract
         self._custom_colors = custom_colors
+        self._engine = engine
+        self._pool = pool
+        self._workers = workers
+        self._preview_scale = preview_scale
+        self._icc_cache = icc_cache
+        self._peephole = peephole
+        # Tiled mode: the image goes through resize, conversion and decomposition tile_rows rows at a time, into
+        # memory-mapped channels in a temporary directory under tile_dir
+        self._tile_rows = tile_rows
+        self._tile_dir = tile_dir
+        self._tile_file = None
+        # "gzip" or "zstd": the level and combined G-code files are written as a compressed stream, .gcode.gz or .gcode.zst
+        self._compression = compression
+        # Stage timers and counters, shared with the caller when given one
+        self.stats = stats if stats is not None else StageStats()
 
         self._verbose = verbose
 
@@ -67,89 +98,203 @@ class I2GC:
             (0, 0, 0),  # Kroma / Key
         ]
         self._cmykstr = ["C", "M", "Y", "K"]
+        self.channels = None
         self._custom_channels = []
 
-    def process_level(self, channel, j):
-        c = self._cmykstr[channel] if not self._grayscale else "K"
-        if self._verbose:
-            _level_time = datetime.now()
-            print(f"Processing channel {c}, level {j}")
-        _gcfh = open(f"{splitext(self._img_file)[0]}_{c}_{j}.gcode", "w+")
-        output = Image.new("RGB", (self._columns, self._rows), (255, 255, 255))
+    def __getstate__(self):
+        # Process-pool workers get the channels through shared memory, never pickled
+        state = self.__dict__.copy()
+        for key in ("channels", "_custom_channels", "_jgcfh", "_gcodes", "stats"):
+            state.pop(key, None)
+        return state
+
+    def _ink_runs(self, mask):
+        """Return (rows, starts, stops) of every horizontal ink run in a level mask, stops exclusive."""
+        _padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+        _padded[:, 1:-1] = mask
+        _edges = np.diff(_padded, axis=1)
+        rows, starts = np.nonzero(_edges == 1)
+        _, stops = np.nonzero(_edges == -1)
+        return rows, starts, stops
+
+    def _scan_level(self, work_channel, threshold, dy, writer, mask=None):
+        """Threshold the channel band by band and emit serpentine strokes per ink run.
+
+        There is a single band unless tiled. Bands are taken bottom up like the rows, carrying the row parity and the
+        retraction state across band edges, so the strokes are the same whatever the band height. The mask is written
+        into the given array, if any, and returned.
+        """
+        work_channel = np.asarray(work_channel)
+        if mask is None:
+            mask = np.empty((self._rows, self._columns), dtype=bool)
+        band_rows = self._tile_rows or self._rows
+        xt = 0
+        strokes = 0
+        ret = False
+        for y1 in range(self._rows, 0, -band_rows):
+            y0 = max(y1 - band_rows, 0)
+            np.greater(work_channel[y0:y1], threshold, out=mask[y0:y1])
+            rows, starts, stops = self._ink_runs(mask[y0:y1])
+            bounds = np.searchsorted(rows, np.arange(y1 - y0 + 1)).tolist()
+            starts, stops = starts.tolist(), stops.tolist()
+            strokes += len(starts)
+            for y in range(y1 - 1, y0 - 1, -1):
+                row = self._rows - 1 - y
+                first, last = bounds[y - y0], bounds[y - y0 + 1]
+                runs = range(last - 1, first - 1, -1) if row % 2 else range(first, last)
+                for n in runs:
+                    start, stop = starts[n], stops[n]
+                    e = stop - start
+                    # Pen positions match the reference loop: it lifts one pixel past the run, clamped to the row
+                    if row % 2:
+                        x_down, x_up = stop, max(start - 1, 0)
+                    else:
+                        x_down, x_up = start, min(stop + 1, self._columns)
+                    # Start drawing
+                    if n == runs[0] and y != self._rows - 1:
+                        writer.move(X=x_down * self._x_step, Y=(self._rows - 1 - y) * self._y_step + dy)
+                    else:
+                        writer.move(X=x_down * self._x_step)
+                    writer.rapid(Z=min(self._z_step, 0), E=self._retract if self._retract and ret else None)
+                    # Stop drawing
+                    writer.move(X=x_up * self._x_step, E=(e * self._x_step * self._e_speed) if self._e_speed else None)
+                    writer.rapid(Z=max(self._z_step, 0), E=-self._retract if self._retract else None)
+                    if self._retract:
+                        ret = True
+                    xt += e
+        return mask, xt, strokes
+
+    def _scan_level_reference(self, work_channel, threshold, dy, writer, output, ink):
+        """Per-pixel scanline, kept as the reference for the vectorized engine."""
         xp, yp, pen_down = 0, self._rows - 1, 0
         row = 0
-        threshold = j * 255 / self._levels
-        gcodes = [GCodeFeedRate(2000), GCodeRapidMove(Z=max(self._z_step, 0))]
-        if self._temperature:
-            gcodes.append(f"M109 S{self._temperature}")
-        if self._e_speed:
-            gcodes.append("M83")
-        dy = 0
-        if j > 0:
-            dy = self._y_step / self._levels
-            l = self._levels - j
-            k = l // 2 + l % 2
-            s = 1 - 2 * ((l + channel) % 2)
-            dy = dy * s * k
-            gcodes.append(self.GCodeMove(Y=dy))
         e = 0
         xt = 0
+        strokes = 0
         ret = False
-        _work_channel = self.channels[channel] if channel < len(self.channels) else self._custom_channels[channel - len(self.channels)]
         for y in range(self._rows - 1, -1, -1):
             start, stop, step = (self._columns - 1, -1, -1) if row % 2 else (0, self._columns, 1)
             for x in range(start, stop, step):
-                if _work_channel.getpixel((x, y)) > threshold:
+                if work_channel.getpixel((x, y)) > threshold:
                     e += 1
-                    output.putpixel((x, y), self._cmyk[channel] if not self._grayscale else self._cmyk[3])
+                    output.putpixel((x, y), ink)
                     if not pen_down:
                         # Start drawing
                         if y != yp:
-                            gcodes.append(
-                                self.GCodeMove(
-                                    X=(x + (1 if step < 0 else 0)) * self._x_step,
-                                    Y=(self._rows - 1 - y) * self._y_step + dy,
-                                )
+                            writer.move(
+                                X=(x + (1 if step < 0 else 0)) * self._x_step,
+                                Y=(self._rows - 1 - y) * self._y_step + dy,
                             )
                         else:
-                            gcodes.append(self.GCodeMove(X=(x + (1 if step < 0 else 0)) * self._x_step))
-                        gcodes.append(GCodeRapidMove(Z=min(self._z_step, 0)))
-                        if self._retract and ret:
-                            gcodes[-1] = f"{str(gcodes[-1])} E{self._retract}"
+                            writer.move(X=(x + (1 if step < 0 else 0)) * self._x_step)
+                        writer.rapid(Z=min(self._z_step, 0), E=self._retract if self._retract and ret else None)
                         xp, yp, pen_down = (x, y, 1)
                 elif pen_down:
                     # Stop drawing
-                    gcodes.append(self.GCodeMove(X=(x + (1 if step > 0 else 0)) * self._x_step))
-                    if self._e_speed:
-                        gcodes[-1] = f"{str(gcodes[-1])} E{(e * self._x_step * self._e_speed)}"
-                    gcodes.append(GCodeRapidMove(Z=max(self._z_step, 0)))
+                    writer.move(X=(x + (1 if step > 0 else 0)) * self._x_step, E=(e * self._x_step * self._e_speed) if self._e_speed else None)
+                    writer.rapid(Z=max(self._z_step, 0), E=-self._retract if self._retract else None)
                     if self._retract:
-                        gcodes[-1] = f"{str(gcodes[-1])} E{-self._retract}"
                         ret = True
                     xp, yp, pen_down, e, xt = (x, y, 0, 0, xt + e)
+                    strokes += 1
                 if x == stop - step and pen_down:
                     # Stop drawing
-                    gcodes.append(self.GCodeMove(X=(x + (1 if step > 0 else 0)) * self._x_step))
-                    if self._e_speed:
-                        gcodes[-1] = f"{str(gcodes[-1])} E{(e * self._x_step * self._e_speed)}"
-                    gcodes.append(GCodeRapidMove(Z=max(self._z_step, 0)))
+                    writer.move(X=(x + (1 if step > 0 else 0)) * self._x_step, E=(e * self._x_step * self._e_speed) if self._e_speed else None)
+                    writer.rapid(Z=max(self._z_step, 0), E=-self._retract if self._retract else None)
                     if self._retract:
-                        gcodes[-1] = f"{str(gcodes[-1])} E{-self._retract}"
                         ret = True
                     xp, yp, pen_down, e, xt = (x, y, 0, 0, xt + e)
+                    strokes += 1
             row += 1
-        gcodes.append(GCodeRapidMove(X=0, Y=0))
-        out_gcode = "\n".join(str(g) for g in gcodes)
-        _gcfh.write(out_gcode)
+        return xt, strokes
+
+    def _preview(self, mask, ink):
+        """Two-color palette preview of a level mask, saved as a 1-bit PNG."""
+        if self._tile_file:
+            # Read the memory-mapped mask in place rather than copying it
+            output = Image.frombuffer("P", (self._columns, self._rows), mask.view(np.uint8), "raw", "P", 0, 1)
+        else:
+            output = Image.frombytes("P", (self._columns, self._rows), mask.view(np.uint8).tobytes())
+        output.putpalette([255, 255, 255, *ink])
+        return output
+
+    def process_level(self, channel, j):
+        c = self._cmykstr[channel] if not self._grayscale else "K"
+        _start_time = time.perf_counter()
+        if self._verbose:
+            _level_time = datetime.now()
+            print(f"Processing channel {c}, level {j}")
+        _gcode_file = compressed_path(f"{splitext(self._img_file)[0]}_{c}_{j}.gcode", self._compression)
+        _gcfh = open_gcode(_gcode_file, "w")
+        threshold = j * 255 / self._levels
+        gcodes = GCodeWriter(_gcfh, fast=self._fast, peephole=self._peephole)
+        gcodes.feed_rate(2000)
+        gcodes.rapid(Z=max(self._z_step, 0))
+        if self._temperature:
+            gcodes.raw(f"M109 S{self._temperature}")
+        if self._e_speed:
+            gcodes.raw("M83")
+        dy = 0
+        if j > 0:
+            dy = self._y_step / self._levels
+            l = self._levels - j
+            k = l // 2 + l % 2
+            s = 1 - 2 * ((l + channel) % 2)
+            dy = dy * s * k
+            gcodes.move(Y=dy)
+        _work_channel = self.channels[channel] if channel < len(self.channels) else self._custom_channels[channel - len(self.channels)]
+        _ink = self._cmyk[channel] if not self._grayscale else self._cmyk[3]
+        if self._engine == "reference":
+            if isinstance(_work_channel, np.ndarray):
+                _work_channel = Image.fromarray(_work_channel, "L")
+            output = Image.new("RGB", (self._columns, self._rows), (255, 255, 255))
+            xt, strokes = self._scan_level_reference(_work_channel, threshold, dy, gcodes, output, _ink)
+        else:
+            _mask = None
+            if self._tile_file:
+                _mask = np.lib.format.open_memmap(join(dirname(self._tile_file), f"mask_{channel}_{j}.npy"), mode="w+", dtype=bool, shape=(self._rows, self._columns))
+            mask, xt, strokes = self._scan_level(_work_channel, threshold, dy, gcodes, _mask)
+            output = self._preview(mask, _ink) if self._preview_scale else None
+        gcodes.rapid(X=0, Y=0)
+        gcodes.flush()
         _gcfh.close()
-        output.save(f"{splitext(self._img_file)[0]}_{c}_{j}.png")
+        if self._preview_scale:
+            if self._preview_scale != 1:
+                output = output.resize((max(1, round(self._columns * self._preview_scale)), max(1, round(self._rows * self._preview_scale))), resample=Image.NEAREST)
+            output.save(f"{splitext(self._img_file)[0]}_{c}_{j}.png")
+        if self._tile_file and self._engine != "reference":
+            del output, mask, _mask
+            os.remove(join(dirname(self._tile_file), f"mask_{channel}_{j}.npy"))
         if self._verbose:
             _level_time = datetime.now() - _level_time
             print(f"Channel {c}, level {j}: {_level_time.total_seconds()}s, {xt * self._x_step:.1f}mm")
-        if self._join:
-            self._gcodes[channel].update({j: out_gcode})
+            if gcodes.peephole:
+                print(f"Channel {c}, level {j} peephole: {gcodes.peephole.report()}")
+        self.stats.add(
+            "i2gc:level", time.perf_counter() - _start_time,
+            pixels=self._rows * self._columns, strokes=strokes, moves=gcodes.lines, painted_mm=xt * self._x_step, bytes=gcodes.bytes,
+        )
+        return _gcode_file
 
     def process_custom_color(self, _cmyk):
+        """Split a custom color off the CMYK channels with whole-array operations."""
+        if self._engine == "reference":
+            return self._process_custom_color_reference(_cmyk)
+        _channels, _new_channel = self._decompose([np.asarray(self.channels[n]) for n in range(4)], _cmyk)
+        self.channels = tuple(Image.fromarray(_channel, "L") for _channel in _channels) + tuple(self.channels[4:])
+        self._custom_channels.append(Image.fromarray(_new_channel, "L"))
+
+    def _decompose(self, channels, _cmyk):
+        """Return the four CMYK arrays with a custom color taken out, and that color's channel."""
+        _alpha = np.full(channels[0].shape, np.inf)
+        for n in range(4):
+            np.minimum(_alpha, channels[n] / _cmyk[n] if _cmyk[n] else 1.0, out=_alpha)
+        # Same wrap-around as the reference, which casts floor(256 * alpha) straight to uint8
+        _new_channel = np.floor(256 * _alpha).astype(np.int64).astype(np.uint8)
+        return [(channels[n] - np.floor(_cmyk[n] * _alpha)).astype(np.uint8) for n in range(4)], _new_channel
+
+    def _process_custom_color_reference(self, _cmyk):
+        """Per-pixel decomposition, kept as the reference for process_custom_color."""
         _new_channel = []
         for y in range(0, self._rows, 1):
             for x in range(0, self._columns, 1):
@@ -161,10 +306,62 @@ class I2GC:
         _new_channel = Image.fromarray(np.uint8(_ra), "L")
         self._custom_channels.append(_new_channel)
 
-    def process(self):
-        if self._verbose:
-            _start_time = datetime.now()
+    def _schedule_levels(self, channels):
+        """Return every (channel, level) pair, largest first by the number of inked pixels."""
+        _tasks = []
+        for channel in range(channels):
+            _work_channel = self.channels[channel] if channel < len(self.channels) else self._custom_channels[channel - len(self.channels)]
+            _histogram = np.bincount(np.asarray(_work_channel).ravel(), minlength=256)
+            _inked = np.cumsum(_histogram[::-1])[::-1]
+            for j in range(self._levels):
+                threshold = j * 255 / self._levels
+                _tasks.append((-int(_inked[math.floor(threshold) + 1]), channel, j))
+        return [(channel, j) for _, channel, j in sorted(_tasks)]
+
+    def _collect_levels(self, futures):
+        """Append levels to their channel's combined file as they finish, holding out-of-order levels until their turn."""
+        _next = {channel: 0 for channel in self._gcodes}
+        for future in as_completed(futures):
+            channel, j = futures[future]
+            _gcode_file = future.result()
+            if isinstance(_gcode_file, tuple):
+                # Process-pool workers send their stats back with the file
+                _gcode_file, _stages = _gcode_file
+                self.stats.merge(_stages)
+            if not self._join:
+                continue
+            self._gcodes[channel][j] = _gcode_file
+            while _next[channel] in self._gcodes[channel]:
+                with open_gcode(self._gcodes[channel].pop(_next[channel])) as _gcfh:
+                    shutil.copyfileobj(_gcfh, self._jgcfh[channel])
+                _next[channel] += 1
+            if _next[channel] == self._levels:
+                self._jgcfh[channel].close()
+
+    def _run_process_pool(self, channels, tasks):
+        """Run process_level in worker processes that read all channels from one shared memory block."""
+        _shape = (channels, self._rows, self._columns)
+        if self._tile_file:
+            # Tiled channels are in a file already, which the workers map themselves
+            with ProcessPoolExecutor(max_workers=self._workers, initializer=_init_level_worker, initargs=(self, None, _shape)) as executor:
+                self._collect_levels({executor.submit(_process_level_worker, *task): task for task in tasks})
+            return
+        _shm = shared_memory.SharedMemory(create=True, size=math.prod(_shape))
+        try:
+            _shared = np.ndarray(_shape, dtype=np.uint8, buffer=_shm.buf)
+            for channel, _work_channel in enumerate(list(self.channels) + self._custom_channels):
+                _shared[channel] = np.asarray(_work_channel)
+            with ProcessPoolExecutor(max_workers=self._workers, initializer=_init_level_worker, initargs=(self, _shm.name, _shape)) as executor:
+                self._collect_levels({executor.submit(_process_level_worker, *task): task for task in tasks})
+            del _shared
+        finally:
+            _shm.close()
+            _shm.unlink()
+
+    def _prepare(self):
+        """Load, resize and separate the image into self.channels, splitting off the custom colors."""
         image = Image.open(self._img_file)
+        interpolation = None
         if self._columns or self._rows:
             height, width = image.size
             interpolation = Image.BOX
@@ -174,72 +371,256 @@ class I2GC:
                 self._rows = int(height * (self._columns / width))
             elif not self._columns:
                 self._columns = int(width * (self._rows / height))
-            image = image.resize((self._columns, self._rows), resample=interpolation)
-        self._columns, self._rows = image.size
+        else:
+            self._columns, self._rows = image.size
         self._x_step, self._y_step = (self._width / self._columns, self._height / self._rows)
-        if self._grayscale:
-            image = image.convert("L")
-        elif "RGB" in image.mode:
-            image = ImageCms.profileToProfile(image, f"{color_profile_dir}/sRGB_v4_ICC_preference.icc", self._profile, outputMode="CMYK")
-        self.channels = image.split()
-        if self._custom_colors:
-            if self._grayscale:
-                print("Error: Custom colors are incompatible with grayscale! Exiting.")
+        _cmyks = self._custom_cmyks()
+        if self._tile_rows:
+            if self._engine == "reference":
+                print("Error: Tiled processing is incompatible with the reference engine! Exiting.")
                 exit()
-            _cmyks = {}
-            for _color in self._custom_colors:
-                if self._verbose:
-                    print(f"Converting custom color: {_color}")
-                _rgb = ImageColor.getrgb(_color)
-                if _rgb in [(0, 0, 0), (255, 255, 0), (255, 0, 255), (0, 255, 255)]:
-                    print("Custom color: {} is a CMYK color. Skipping.")
-                    continue
+            self._prepare_tiled(image, interpolation, _cmyks)
+        else:
+            if interpolation is not None:
+                image = image.resize((self._columns, self._rows), resample=interpolation)
+            self.channels = self._convert(image).split()
+            for _cmyk, _color in _cmyks:
                 if self._verbose:
-                    print(f"RGB: {_rgb}")
-                _ti = Image.new("RGB", (1, 1), _rgb)
-                _ti = ImageCms.profileToProfile(
-                    _ti,
-                    f"{color_profile_dir}/sRGB_v4_ICC_preference.icc",
-                    self._profile,
-                    outputMode="CMYK",
-                )
-                self._cmyk.append(_rgb)
-                self._cmykstr.append(_color)
-                _cmyk = _ti.getpixel((0, 0))
-                _i = 0
-                for _v in _cmyk:
-                    _i += _v
-                _cmyks[_i] = [_cmyk, _color]
-                if self._verbose:
-                    print(f"CMYK: {_cmyk}")
-            for _a in sorted(_cmyks.items()):
-                if self._verbose:
-                    print(f"Processing custom color: {_a[1][1]}")
-                self.process_custom_color(_a[1][0])
+                    print(f"Processing custom color: {_color}")
+                self.process_custom_color(_cmyk)
         if self._custom_colors and self._verbose:
             print("Custom colors done")
+
+    def _convert(self, image):
+        """Convert the (resized) image, or a band of it, to grayscale or to CMYK with the output profile."""
+        if self._grayscale:
+            return image.convert("L")
+        if "RGB" in image.mode:
+            return color_transform.convert(image, f"{color_profile_dir}/sRGB_v4_ICC_preference.icc", self._profile, "CMYK", lut_dir=self._icc_cache)
+        return image
+
+    def _custom_cmyks(self):
+        """Add the custom colors to the channel names and return their CMYK values in the order they are split off."""
+        if not self._custom_colors:
+            return []
+        if self._grayscale:
+            print("Error: Custom colors are incompatible with grayscale! Exiting.")
+            exit()
+        _cmyks = {}
+        _rgbs = []
+        for _color in self._custom_colors:
+            if self._verbose:
+                print(f"Converting custom color: {_color}")
+            _rgb = ImageColor.getrgb(_color)
+            if _rgb in [(0, 0, 0), (255, 255, 0), (255, 0, 255), (0, 255, 255)]:
+                print("Custom color: {} is a CMYK color. Skipping.")
+                continue
+            if self._verbose:
+                print(f"RGB: {_rgb}")
+            _rgbs.append((_rgb, _color))
+        # All custom colors go through the transform in one batched 1xN image
+        _ti = Image.new("RGB", (max(len(_rgbs), 1), 1))
+        _ti.putdata([_rgb for _rgb, _ in _rgbs])
+        _ti = color_transform.convert(_ti, f"{color_profile_dir}/sRGB_v4_ICC_preference.icc", self._profile, "CMYK", lut_dir=self._icc_cache)
+        for _n, (_rgb, _color) in enumerate(_rgbs):
+            self._cmyk.append(_rgb)
+            self._cmykstr.append(_color)
+            _cmyk = _ti.getpixel((_n, 0))
+            _i = 0
+            for _v in _cmyk:
+                _i += _v
+            _cmyks[_i] = [_cmyk, _color]
+            if self._verbose:
+                print(f"CMYK: {_cmyk}")
+        return [(_cmyk, _color) for _, (_cmyk, _color) in sorted(_cmyks.items())]
+
+    def _prepare_tiled(self, image, interpolation, _cmyks):
+        """Resize, convert and split the image tile_rows rows at a time into one memory-mapped (channel, row, column) file.
+
+        Only one band of the resized image is in memory at a time, though the source image is decoded whole; the
+        channels are slices of the file, which the OS pages in and out as the levels read them.
+        """
+        self._tile_file = join(tempfile.mkdtemp(prefix="i2gc_", dir=self._tile_dir), "channels.npy")
+        if interpolation is not None and image.mode not in _RESAMPLE_MODES and image.mode not in _PREMULTIPLIED_MODES:
+            # Pillow resizes these modes differently (palette and 1-bit images nearest neighbour), so all at once
+            image, interpolation = image.resize((self._columns, self._rows), resample=interpolation), None
+        width = image.size[0]
+        _file = None
+        for y0 in range(0, self._rows, self._tile_rows):
+            y1 = min(y0 + self._tile_rows, self._rows)
+            if interpolation is None:
+                _band = image.crop((0, y0, width, y1))
+            else:
+                _band = _resize_rows(image, (self._columns, self._rows), interpolation, y0, y1)
+            _band = [np.asarray(_channel) for _channel in self._convert(_band).split()]
+            if _file is None:
+                _channels = len(_band)
+                _file = np.lib.format.open_memmap(self._tile_file, mode="w+", dtype=np.uint8, shape=(_channels + len(_cmyks), self._rows, self._columns))
+            for _n, (_cmyk, _color) in enumerate(_cmyks):
+                _band[:4], _file[_channels + _n, y0:y1] = self._decompose(_band[:4], _cmyk)
+            _file[:_channels, y0:y1] = np.stack(_band)
+            if self._verbose:
+                print(f"Tile rows {y0}-{y1 - 1} of {self._rows}")
+        _file.flush()
+        self.channels = [_file[channel] for channel in range(_channels)]
+        self._custom_channels = [_file[_channels + _n] for _n in range(len(_cmyks))]
+
+    def masks(self, selection):
+        """Return {(channel, level): mask} for just the selected levels, e.g. [("C", 0), ("#5897D0", 2)].
+
+        Channels are named as in the output files: C, M, Y, K or the custom color as given. Only the selected levels
+        are thresholded and nothing is written, for callers that pass the masks straight to the next stage. Tiled, the
+        memory-mapped channels are removed again once the masks are taken.
+        """
+        try:
+            if self.channels is None:
+                with self.stats.stage("i2gc:setup") as counters:
+                    self._prepare()
+                    counters["pixels"] = self._rows * self._columns
+            _masks = {}
+            with self.stats.stage("i2gc:masks") as counters:
+                for c, j in selection:
+                    channel = 0 if self._grayscale else self._cmykstr.index(c)
+                    _work_channel = self.channels[channel] if channel < len(self.channels) else self._custom_channels[channel - len(self.channels)]
+                    _masks[(c, j)] = np.asarray(_work_channel) > j * 255 / self._levels
+                counters["pixels"] = len(selection) * self._rows * self._columns
+        finally:
+            self._remove_tiles()
+        return _masks
+
+    def _remove_tiles(self):
+        """Drop the memory-mapped channels of tiled mode and remove their directory, if there are any."""
+        if self._tile_file:
+            self.channels, self._custom_channels = None, []
+            shutil.rmtree(dirname(self._tile_file), ignore_errors=True)
+            self._tile_file = None
+
+    def process(self):
         if self._verbose:
-            _setup_time = datetime.now() - _start_time
-            print(f"Setup: {_setup_time.total_seconds()}s")
-        _results_gen = []
-        _r = len(self.channels) + len(self._custom_channels)
-        with PoolExecutor() as executor:
+            _start_time = datetime.now()
+        try:
+            with self.stats.stage("i2gc:setup") as counters:
+                self._prepare()
+                counters["pixels"] = self._rows * self._columns
+            if self._verbose:
+                _setup_time = datetime.now() - _start_time
+                print(f"Setup: {_setup_time.total_seconds()}s")
+            _r = len(self.channels) + len(self._custom_channels)
             for channel in range(_r):
                 self._gcodes.update({channel: {}})
                 c = self._cmykstr[channel] if not self._grayscale else "K"
                 if self._join:
-                    self._jgcfh.update({channel: open(f"{splitext(self._img_file)[0]}_{c}_combined_0-{self._levels - 1}.gcode", "w+")})
-                _results_gen.append(executor.map(partial(self.process_level, channel), range(self._levels)))
-        if self._join and _results_gen:
-            for channel in range(_r):
-                for j in range(self._levels):
-                    self._jgcfh[channel].write(self._gcodes[channel][j])
-                self._jgcfh[channel].close()
+                    self._jgcfh.update({channel: open_gcode(compressed_path(f"{splitext(self._img_file)[0]}_{c}_combined_0-{self._levels - 1}.gcode", self._compression), "w")})
+            _tasks = self._schedule_levels(_r)
+            if self._pool == "process":
+                self._run_process_pool(_r, _tasks)
+            else:
+                with PoolExecutor(max_workers=self._workers) as executor:
+                    self._collect_levels({executor.submit(self.process_level, *task): task for task in _tasks})
+        finally:
+            # Also when a level fails, so the full-size channels do not stay behind in tile_dir
+            self._remove_tiles()
         if self._verbose:
             _run_time = datetime.now() - _start_time
             print(f"Run time: {_run_time.total_seconds()}s")
 
 
+# Pillow's resampling filters as (function, support); the 8-bit modes it filters directly, and the ones it premultiplies
+_FILTERS = {
+    Image.BOX: (lambda x: 1.0 if -0.5 < x <= 0.5 else 0.0, 0.5),
+    Image.LANCZOS: (lambda x: _sinc(x) * _sinc(x / 3) if -3.0 <= x < 3.0 else 0.0, 3.0),
+}
+_RESAMPLE_MODES = {"L", "RGB", "RGBX", "CMYK", "YCbCr", "LAB", "HSV"}
+_PREMULTIPLIED_MODES = {"LA": "La", "RGBA": "RGBa"}
+
+
+def _sinc(x):
+    if x == 0.0:
+        return 1.0
+    x = x * math.pi
+    return math.sin(x) / x
+
+
+def _resample_coefficients(in_size, out_size, resample, first, last):
+    """Pillow's fixed-point coefficients for output rows first to last - 1 of resizing in_size rows to out_size.
+
+    Returns the first input row of each output row and its (rows, taps) coefficients, computed as Pillow's
+    precompute_coeffs and normalize_coeffs_8bpc do, so the rows come out as in a resize of the whole image.
+    """
+    _filter, support = _FILTERS[resample]
+    scale = filterscale = in_size / out_size
+    if filterscale < 1.0:
+        filterscale = 1.0
+    support = support * filterscale
+    ksize = math.ceil(support) * 2 + 1
+    starts, coefficients = [], np.zeros((last - first, ksize), dtype=np.int64)
+    for row, y in enumerate(range(first, last)):
+        center = (y + 0.5) * scale
+        ymin = max(int(center - support + 0.5), 0)
+        ymax = min(int(center + support + 0.5), in_size) - ymin
+        weights = [_filter((k + ymin - center + 0.5) / filterscale) for k in range(ymax)]
+        total = 0.0
+        for weight in weights:
+            total += weight
+        for k, weight in enumerate(weights):
+            if total != 0.0:
+                weight /= total
+            coefficients[row, k] = int(-0.5 + weight * (1 << 22)) if weight < 0 else int(0.5 + weight * (1 << 22))
+        starts.append(ymin)
+    return np.array(starts), coefficients
+
+
+def _resize_rows(image, size, resample, y0, y1):
+    """Rows y0 to y1 - 1 of image.resize(size, resample), from just the source rows they are filtered from.
+
+    Pillow resizes horizontally, then vertically in 8-bit fixed point; the horizontal pass runs on the source rows in
+    Pillow and the vertical pass here with its coefficients, since a resize of a box of the source rounds differently.
+    """
+    columns, rows = size
+    mode = _PREMULTIPLIED_MODES.get(image.mode, image.mode)
+    width, height = image.size
+    if rows == height:
+        starts, coefficients = np.arange(y0, y1), np.full((y1 - y0, 1), 1 << 22, dtype=np.int64)
+    else:
+        starts, coefficients = _resample_coefficients(height, rows, resample, y0, y1)
+    first, last = int(starts.min()), min(int(starts.max()) + coefficients.shape[1], height)
+    band = image.crop((0, first, width, last))
+    if mode != image.mode:
+        band = band.convert(mode)
+    if columns != width:
+        band = band.resize((columns, last - first), resample=resample)
+    source = np.asarray(band).astype(np.int64)
+    output = np.full(((y1 - y0),) + source.shape[1:], 1 << 21, dtype=np.int64)
+    for k in range(coefficients.shape[1]):
+        # Taps past the end of the source have no weight; they read its last row
+        rows_k = np.minimum(starts - first + k, last - first - 1)
+        output += source[rows_k] * coefficients[:, k].reshape((-1,) + (1,) * (source.ndim - 1))
+    output = np.clip(output >> 22, 0, 255).astype(np.uint8)
+    band = Image.frombytes(mode, (columns, y1 - y0), output.tobytes())
+    return band.convert(image.mode) if mode != image.mode else band
+
+
+_worker_i2gc = None
+_worker_shm = None
+
+
+def _init_level_worker(i2gc, shm_name, shape):
+    global _worker_i2gc, _worker_shm
+    if shm_name is None:
+        _shared = np.load(i2gc._tile_file, mmap_mode="r")
+    else:
+        _worker_shm = shared_memory.SharedMemory(name=shm_name)
+        _shared = np.ndarray(shape, dtype=np.uint8, buffer=_worker_shm.buf)
+    i2gc.channels = [_shared[channel] for channel in range(shape[0])]
+    i2gc._custom_channels = []
+    _worker_i2gc = i2gc
+
+
+def _process_level_worker(channel, j):
+    _worker_i2gc.stats = StageStats()
+    return _worker_i2gc.process_level(channel, j), _worker_i2gc.stats.stages
+
+
 def main():
     import argparse
 
@@ -260,6 +641,17 @@ def main():
     argparser.add_argument("-j", "--join", dest="join", action="store_true", help="Also output joined gcodes for all levels in a channel")
     argparser.add_argument("-g", "--grayscale", dest="grayscale", action="store_true", help="Grayscale output (experimental)")
     argparser.add_argument("-C", "--custom_color", dest="custom_color", action="extend", nargs="+", default=None, help="Specify additional custom color channels", type=str)
+    argparser.add_argument("--pool", dest="pool", default="thread", choices=["thread", "process"], help="Run levels in a thread or process pool", type=str)
+    argparser.add_argument("-w", "--workers", dest="workers", default=None, help="Pool size (default: CPU count)", type=int)
+    argparser.add_argument("--no-preview", dest="preview_scale", action="store_const", const=0, default=1, help="Do not write the per-level PNG previews")
+    argparser.add_argument("--preview-scale", dest="preview_scale", default=1, help="Scale of the per-level PNG previews", type=float)
+    argparser.add_argument("--icc_cache", dest="icc_cache", default=None, help="Directory for cached color transform lookup tables", type=str)
+    argparser.add_argument("--peephole", dest="peephole", action="store_true", help="Drop G-code lines that change nothing (redundant feed, Z and mode commands)")
+    argparser.add_argument("--tile-rows", dest="tile_rows", default=None, help="Process the image in bands of this many rows through memory-mapped files, for images larger than memory", type=int)
+    argparser.add_argument("--tile-dir", dest="tile_dir", default=None, help="Directory for the memory-mapped files of --tile-rows (default: system temp)", type=str)
+    argparser.add_argument("--compress", dest="compression", default=None, choices=list(COMPRESSIONS), help="Write the G-code files compressed", type=str)
+    argparser.add_argument("--stats", dest="stats", default=None, help="Write the stage timers and counters to this JSON file", type=str)
+    argparser.add_argument("--engine", dest="engine", default="numpy", choices=["numpy", "reference"], help="Scanline engine (reference: per-pixel loop)", type=str)
 
     args = argparser.parse_args()
 
@@ -268,10 +660,9 @@ def main():
         for key, value in vars(args).items():
             print(f"  {key}={value}")
 
-        from utils import trace_py_files
-        import sys
+        from utils import trace_py_imports
 
-        sys.settrace(trace_py_files)
+        trace_py_imports()
 
     i2gc = I2GC(
         img_file=args.img_file,
@@ -290,12 +681,24 @@ def main():
         extruder_speed=args.e_speed,
         retract=args.retract,
         custom_colors=args.custom_color,
+        engine=args.engine,
+        pool=args.pool,
+        workers=args.workers,
+        preview_scale=args.preview_scale,
+        icc_cache=args.icc_cache,
+        peephole=args.peephole,
+        tile_rows=args.tile_rows,
+        tile_dir=args.tile_dir,
+        compression=args.compression,
     )
     i2gc.process()
 
+    if args.stats:
+        i2gc.stats.write(args.stats)
     if args.verbose:
         from utils import all_traced_filenames
 
+        print(f"Stages:\n{i2gc.stats}")
         print(f"All accessed python files: {all_traced_filenames}")
 
     print("Done i2gc.")
@@ -1,20 +1,26 @@
 #!/usr/bin/python3
+import functools
+import hashlib
 import os
 import shutil
 import threading
 import json
 import subprocess
+import time
 import traceback
+from glob import glob, escape as glob_escape
 from typing import Literal
-from xml.etree import ElementTree
-
-from PIL import Image
-from openscad_runner import OpenScadRunner
-from wand.image import Image as WImage
 
+from artifact_cache import ArtifactCache, source_version, tool_version
 from copicograf import Copicograf
+from gcode_reader import compressed_path, copy_gcode
+from stage_stats import StageStats
+from task_graph import TaskGraph
 from utils import color_profile_dir, cmyk_to_name
 
+# Heavy dependencies (ImageMagick, OpenSCAD, OpenCV, the ICC engine) are imported by the stages that use them, so
+# --help, --steps cmyk and G-code only runs do not load them
+
 
 class CMYK:
     def __init__(
@@ -23,16 +29,41 @@ class CMYK:
         output: str,
         configuration: str,
         steps: Literal["all", "cmyk", "gcode"] | str,
+        cache_dir: str | None = None,
+        cache_size: int = 2 << 30,
+        workers: int | None = None,
+        compression: str | None = None,
     ):
         self.file = file
         self.output = output
         self.configuration = configuration
         self.steps = steps
 
+        # Stage outputs keyed by their inputs, so a rerun only redoes the stages whose inputs changed
+        self.cache = ArtifactCache(cache_dir, cache_size) if cache_dir else None
+        # Pool size for the per-color stage graph, see process()
+        self.workers = workers
+        # "gzip" or "zstd": the G-code of every stage (i2gc, slicer, simplify, reorder, Copicograf) is written compressed
+        self.compression = compression
+        self._dimensions_lock = threading.Lock()
+        # Level masks by color when the separation runs in process, see _separate_in_process
+        self._masks = None
+        # Stage timers and counters of the whole run, including the i2gc and Copicograf stages
+        self.stats = StageStats()
+
         # Load configuration in JSON as a dictionary
         with open(self.configuration) as f:
             self.conf = json.load(f)
 
+        # Fill path generator: "cura" (OpenSCAD + slicer) or "native" (in process, see fill_paths)
+        self.slicer_engine = self.conf["slicer"].get("engine", "cura")
+        if self.slicer_engine not in ("cura", "native"):
+            raise ValueError(f"Unknown slicer engine: {self.slicer_engine}")
+        # Contour tracing backend: "potrace" (PBM + potrace subprocesses) or "opencv" (in process, see contour_trace)
+        self.tracer = self.conf["separation"].get("tracer", "potrace")
+        if self.tracer not in ("potrace", "opencv"):
+            raise ValueError(f"Unknown tracer: {self.tracer}")
+
         print("Cyan tray x:", self.conf["trays"]["cyan"]["x"])
         print("First additional:", self.conf["additionals"][0])
 
@@ -65,6 +96,8 @@ class CMYK:
 
     def _set_dimensions(self, im_path, svg_dpi=96):
         if im_path.endswith(".svg"):
+            from xml.etree import ElementTree
+
             tree = ElementTree.parse(im_path)
             root = tree.getroot()
 
@@ -94,6 +127,8 @@ class CMYK:
             else:
                 raise ValueError("SVG file does not specify width and height.")
         else:
+            from PIL import Image
+
             im = Image.open(im_path)
             self.im_dpi = im.info["dpi"][0]
             self.im_width_px = im.width
@@ -104,30 +139,100 @@ class CMYK:
         print("Height (px): ", self.im_height_px)
 
     def process(self):  # image_to_gcode
-        if self.steps == "all":
-            if self.file.endswith(".svg"):
-                self._collect_svgs()
-            else:
-                self._cmyk_separation_script(self.file)
-                self._convert_jpgs_to_svgs()
-            self._convert_svgs_to_stls()
-            self._create_slicer_gcodes()
-            self._create_copicograf_gcode(self.output)
-        elif self.steps == "cmyk":
-            if self.file.endswith(".svg"):
-                raise ValueError("Cannot process a svg file with cmyk steps")
-            else:
-                self._cmyk_separation_script(self.file)
-        elif self.steps == "gcode":
-            if self.file.endswith(".svg"):
-                self._collect_svgs()
-            else:
-                self._convert_jpgs_to_svgs()
-            self._convert_svgs_to_stls()
-            self._create_slicer_gcodes()
-            self._create_copicograf_gcode(self.output)
-        else:
+        if self.steps not in ("all", "cmyk", "gcode"):
             raise ValueError(f"Unknown steps value: {self.steps}")
+        if self.steps == "cmyk" and self.file.endswith(".svg"):
+            raise ValueError("Cannot process a svg file with cmyk steps")
+
+        graph = TaskGraph(self.workers, self.stats)
+        separation = ()
+        if self.steps == "all" and not self.file.endswith(".svg") and self.conf["separation"].get("in_process"):
+            self._masks = {}
+            separation = (graph.add("i2gc:selected", lambda: self._separate_in_process(self.file)),)
+        elif self.steps in ("all", "cmyk") and not self.file.endswith(".svg"):
+            separation = (graph.add("i2gc:all", lambda: self._cmyk_separation_script(self.file)),)
+        if self.steps in ("all", "gcode"):
+            self._add_color_chains(graph, separation)
+        graph.run()
+
+    def _gcode_file(self, name):
+        """A stage's G-code file name, with the extension of self.compression."""
+        return compressed_path(name, self.compression)
+
+    def _color_level(self, color):
+        if color in self.conf["separation"]["selection"]:
+            return self.conf["separation"]["selection"][color]
+        elif color in self.conf["separation"]["selection"]["additionals"]:
+            return self.conf["separation"]["selection"]["additionals"][color]
+        print(f"Warning: unhandled color: {color}")
+        return None
+
+    def _add_color_chains(self, graph, separation):
+        """Add each color's chain, PNG -> PBM -> SVG -> SCAD -> STL -> slicer G-code, and the Copicograf passes.
+
+        With slicer.engine native the SCAD, STL and slicer steps are replaced by fill_paths, fed the level mask (or the
+        collected svg) directly.
+
+        Chains of different colors run side by side; the Copicograf passes append to one output file, so each waits for
+        its color's slicer G-code and for the previous color's pass.
+        """
+        base_file = os.path.splitext(self.file)[0]
+        dimensions_from_svg = False
+        if os.path.exists(self.file):
+            self._set_dimensions(self.file)
+        elif self.file.endswith(".svg"):
+            dimensions_from_svg = True
+        else:
+            print("Warning: image dimensions are not set, scad generation may fail")
+
+        copicograf = Copicograf(conf=self.conf, result_file=self._gcode_file(self.output or "copicograf.gcode"), stats=self.stats)
+        previous = ()
+        for color in self.colors:
+            color_level = self._color_level(color)
+            if color_level is None:
+                continue
+            color_name = cmyk_to_name.get(color, color)
+            svg_file = f"threshold_{color_name}.svg"
+            slicer_gcode = self._gcode_file(f"threshold_{color_name}_slicer.gcode")
+            if self.slicer_engine == "native" and not self.file.endswith(".svg"):
+                # The fill is traced straight from the level mask, with no svg, scad or stl in between
+                source = color if self._masks is not None else f"{base_file}_{color}_{color_level}.png"
+                sliced = graph.add(f"fill:{color_name}", functools.partial(self._fill_level, source, slicer_gcode), separation)
+            else:
+                if self._masks is not None:
+                    svg = graph.add(f"{self.tracer}:{color_name}", functools.partial(self._trace_mask, color, f"threshold_{color_name}.pbm", svg_file), separation)
+                elif self.file.endswith(".svg"):
+                    svg = graph.add(f"collect:{color_name}", functools.partial(shutil.copyfile, f"{base_file}_{color}_{color_level}.svg", svg_file), separation)
+                elif self.tracer == "opencv":
+                    svg = graph.add(f"opencv:{color_name}", functools.partial(self._trace_png, f"{base_file}_{color}_{color_level}.png", svg_file), separation)
+                else:
+                    svg = graph.add(
+                        f"potrace:{color_name}",
+                        functools.partial(self._convert_jpg_to_svg, f"{base_file}_{color}_{color_level}.png", f"threshold_{color_name}.pbm", svg_file),
+                        separation,
+                    )
+                dimensions_file = svg_file if dimensions_from_svg else None
+                if self.slicer_engine == "native":
+                    sliced = graph.add(f"fill:{color_name}", functools.partial(self._fill_svg, svg_file, slicer_gcode, dimensions_file), (svg,))
+                else:
+                    stl = graph.add(
+                        f"openscad:{color_name}",
+                        functools.partial(self._convert_svg_to_stl, f"threshold_{color_name}.scad", svg_file, f"threshold_{color_name}.stl", dimensions_file),
+                        (svg,),
+                    )
+                    sliced = graph.add(
+                        f"slicer:{color_name}",
+                        functools.partial(self._create_slicer_gcode, f"threshold_{color_name}.stl", slicer_gcode, "2.0", False),
+                        (stl,),
+                    )
+            previous = (graph.add(f"copicograf:{color_name}", functools.partial(self._prepare_copicograf_color, copicograf, color), (sliced, *previous)),)
+        graph.add("copicograf:save", functools.partial(copicograf.save_gcode, self.output and self._gcode_file(self.output)), previous)
+
+    def _cached(self, key, outputs, stage):
+        """Run a stage through the cache, if there is one. Returns False when the stage failed."""
+        if self.cache is None:
+            return stage() is not False
+        return self.cache.run(key, outputs, stage)
 
     def _cmyk_separation_script(self, im_path):
         # TODO: replace by a call or multiprocessing
@@ -139,42 +244,95 @@ class CMYK:
             cmd.extend(["--custom_color", color])
 
         cmd.extend(["--levels", str(self.conf["separation"]["levels"])])
-
-        print(cmd)
-        subprocess.run(cmd)
-        # TODO: check return code (or do TODO above)
+        if self.conf["separation"].get("icc_cache"):
+            cmd.extend(["--icc_cache", self.conf["separation"]["icc_cache"]])
+        if self.conf["separation"].get("peephole"):
+            cmd.append("--peephole")
+        if self.compression:
+            cmd.extend(["--compress", self.compression])
+
+        def separate():
+            print(cmd)
+            # The stats file is left out of cmd, which is part of the cache key
+            stats_file = f"{base_file}_stats_{os.getpid()}.json"
+            ok = subprocess.run(cmd + ["--stats", stats_file]).returncode == 0
+            if os.path.exists(stats_file):
+                self.stats.load(stats_file)
+                os.remove(stats_file)
+            return ok
+
+        # i2gc names its outputs after the input image; the ones it wrote are those touched since it started
+        base_file = os.path.splitext(im_path)[0]
+        start_time = time.time()
+        key = ArtifactCache.key(
+            "i2gc", [im_path, self.cmyk_profile], cmd[2:],
+            source_version("i2gc.py", "color_transform.py", "gcode_writer.py", "gcode_peephole.py", "gcode_reader.py"),
+        )
+        return self._cached(key, lambda: [path for path in glob(f"{glob_escape(base_file)}_*") if os.path.getmtime(path) >= start_time - 1], separate)
+
+    def _separate_in_process(self, im_path):
+        """Separate in this process, thresholding only the level each color uses, and keep the masks in memory."""
+        from i2gc import I2GC
+
+        selection = [(color, self._color_level(color)) for color in self.colors]
+        i2gc = I2GC(
+            img_file=im_path,
+            levels=int(self.conf["separation"]["levels"]),
+            width=self.image_width,
+            height=self.image_width,
+            custom_colors=self.conf["additionals"],
+            icc_cache=self.conf["separation"].get("icc_cache"),
+            stats=self.stats,
+        )
+        for (color, _), mask in i2gc.masks([(color, level) for color, level in selection if level is not None]).items():
+            self._masks[color] = mask
 
     def _resize_image(self, im_path):
+        from wand.image import Image as WImage
+
         with WImage(filename=im_path) as img:
             img.resize(self.image_width, self.image_width)
             img.save(filename=im_path)
 
-    def _create_copicograf_gcode(self, result_gcode_path):
-        copicograf = Copicograf(conf=self.conf)
+    def _prepare_copicograf_color(self, copicograf, color):
+        print("copicograf gcode", color)
+        color_name = cmyk_to_name.get(color, color)
+        if color_name in self.conf["trays"]:
+            color_tray_x = int(self.conf["trays"][color_name]["x"])
+            color_tray_y = int(self.conf["trays"][color_name]["y"])
+        elif color_name in self.conf["trays"]["additionals"]:
+            color_tray_x = int(self.conf["trays"]["additionals"][color_name]["x"])
+            color_tray_y = int(self.conf["trays"]["additionals"][color_name]["y"])
+        else:
+            print(f"Warning: unhandled color in copicograf: {color}")
+            return
 
-        for color in self.colors:
-            print("copicograf gcode", color)
-            color_name = cmyk_to_name.get(color, color)
-            if color_name in self.conf["trays"]:
-                color_tray_x = int(self.conf["trays"][color_name]["x"])
-                color_tray_y = int(self.conf["trays"][color_name]["y"])
-            elif color_name in self.conf["trays"]["additionals"]:
-                color_tray_x = int(self.conf["trays"]["additionals"][color_name]["x"])
-                color_tray_y = int(self.conf["trays"]["additionals"][color_name]["y"])
-            else:
-                print(f"Warning: unhandled color in copicograf: {color}")
-                continue
+        slicer_gcode = self._gcode_file(f"threshold_{color_name}_slicer.gcode")
+        if self.conf["brushograph"].get("simplify_tolerance"):
+            from toolpath_simplify import simplify_toolpath
 
-            copicograf.prepare_path(f"threshold_{color_name}_slicer.gcode", color_tray_x, color_tray_y)
+            simplified_gcode = self._gcode_file(f"threshold_{color_name}_slicer_simplified.gcode")
+            simplify_toolpath(
+                slicer_gcode, simplified_gcode,
+                float(self.conf["brushograph"]["simplify_tolerance"]), self.conf["brushograph"].get("simplify_method", "rdp"),
+            )
+            slicer_gcode = simplified_gcode
+        if self.conf["brushograph"].get("reorder_shapes"):
+            from shape_order import reorder_shapes
 
-        copicograf.save_gcode(result_gcode_path)
+            ordered_gcode = self._gcode_file(f"threshold_{color_name}_slicer_ordered.gcode")
+            reorder_shapes(slicer_gcode, ordered_gcode)
+            slicer_gcode = ordered_gcode
+        copicograf.prepare_path(slicer_gcode, color_tray_x, color_tray_y)
 
     def _create_slicer_gcode(self, orig_file, result_file, diameter, draw_walls):
+        # The slicers write plain text; with compression it is compressed into result_file afterwards
+        sliced_file = os.path.splitext(result_file)[0] if self.compression else result_file
         cmd = [
             self.Slic3r,
             "-v",
             "-o",
-            result_file,
+            sliced_file,
             "--layer_height=1",
             "--wall_thickness=1",
             "--top_bottom_thickness=0",
@@ -203,46 +361,35 @@ class CMYK:
             "--retraction_combing=off",
             orig_file,
         ]
-        print(cmd)
-        try:
-            subprocess.run(cmd)
-        except FileNotFoundError:
-            traceback.print_exc()
-            print("Warning: slicer not found, attempting fallback slicer")
-            cmd = [
-                self.fallback_Slic3r,
-                "--gcode",
-                "--output",
-                result_file,
-                orig_file,
-            ]
-            print(cmd)
-            subprocess.run(cmd)
-
-    def _create_slicer_gcodes(self):
-        diam = "2.0"
-        draw_walls = False
 
-        threads = []
-        for color in self.colors:
-            color_name = cmyk_to_name.get(color, color)
-            threads.append(
-                threading.Thread(
-                    target=self._create_slicer_gcode,
-                    args=(
-                        f"threshold_{color_name}.stl",
-                        f"threshold_{color_name}_slicer.gcode",
-                        diam,
-                        draw_walls,
-                    ),
-                )
-            )
-
-        for thread in threads:
-            thread.start()
-
-        for thread in threads:
-            thread.join()
+        def slice_file():
+            print(cmd)
+            try:
+                return subprocess.run(cmd).returncode == 0
+            except FileNotFoundError:
+                traceback.print_exc()
+                print("Warning: slicer not found, attempting fallback slicer")
+                fallback_cmd = [
+                    self.fallback_Slic3r,
+                    "--gcode",
+                    "--output",
+                    sliced_file,
+                    orig_file,
+                ]
+                print(fallback_cmd)
+                return subprocess.run(fallback_cmd).returncode == 0
+
+        def run_slicer():
+            if not slice_file():
+                return False
+            if sliced_file != result_file:
+                copy_gcode(sliced_file, result_file)
+                os.remove(sliced_file)
+            return True
+
+        # Options without the file names, and both slicers' versions since either may run
+        key = ArtifactCache.key("slicer", [orig_file], cmd[4:-1] + [self.compression], (tool_version(self.Slic3r, "--version"), tool_version(self.fallback_Slic3r, "--version")))
+        return self._cached(key, [result_file], run_slicer)
 
     def _create_scad_file(self, scad_file, svg_file):
         with open(scad_file, "w") as f:
@@ -267,74 +414,127 @@ class CMYK:
             f.write("}\n")
             f.write("converter();\n")
 
-    def _convert_svg_to_stl(self, scad_file, orig_file, result_file):
-        self._create_scad_file(scad_file=scad_file, svg_file=orig_file)
-        osr = OpenScadRunner(scriptfile=scad_file, outfile=result_file)
-        osr.run()
-        for line in osr.echos:
-            print(line)
-        for line in osr.warnings:
-            print(line)
-        for line in osr.errors:
-            print(line)
-        if osr.good():
-            print("Successfully created", result_file)
-
-    def _convert_svgs_to_stls(self):
-        dimensions_set = False
-        if os.path.exists(self.file):
-            self._set_dimensions(self.file)
-            dimensions_set = True
-
-        for color in self.colors:
-            color_name = cmyk_to_name.get(color, color)
-
-            if self.file.endswith(".svg") and not os.path.exists(self.file):
-                self._set_dimensions(f"threshold_{color_name}.svg")
-                dimensions_set = True
-
-            if not dimensions_set:
-                print("Warning: image dimensions are not set, scad generation may fail")
-
-            self._convert_svg_to_stl(
-                f"threshold_{color_name}.scad",
-                f"threshold_{color_name}.svg",
-                f"threshold_{color_name}.stl",
-            )
-
-    def _collect_svgs(self):
-        base_file = os.path.splitext(self.file)[0]
-        for color in self.colors:
-            print("collecting svgs for color ", color)
-            if color in self.conf["separation"]["selection"]:
-                color_level = self.conf["separation"]["selection"][color]
-            elif color in self.conf["separation"]["selection"]["additionals"]:
-                color_level = self.conf["separation"]["selection"]["additionals"][color]
-            else:
-                print(f"Warning: unhandled color: {color}")
-                continue
-
-            color_name = cmyk_to_name.get(color, color)
-            shutil.copyfile(f"{base_file}_{color}_{color_level}.svg", f"threshold_{color_name}.svg")
+    def _convert_svg_to_stl(self, scad_file, orig_file, result_file, dimensions_file=None):
+        # Colors share the dimension attributes, so take them and write the scad file in one go
+        with self._dimensions_lock:
+            if dimensions_file:
+                self._set_dimensions(dimensions_file)
+            self._create_scad_file(scad_file=scad_file, svg_file=orig_file)
+
+        def export():
+            from openscad_runner import OpenScadRunner
+
+            osr = OpenScadRunner(scriptfile=scad_file, outfile=result_file)
+            osr.run()
+            for line in osr.echos:
+                print(line)
+            for line in osr.warnings:
+                print(line)
+            for line in osr.errors:
+                print(line)
+            if osr.good():
+                print("Successfully created", result_file)
+            return osr.good()
+
+        # The scad file holds the dimensions and the svg file name, so its bytes stand for the configuration
+        return self._cached(ArtifactCache.key("openscad", [scad_file, orig_file], None, tool_version(self.OPENSCAD, "--version")), [result_file], export)
+
+    def _fill_scale(self, unit_mm, dimensions_file=None):
+        """mm per traced pixel, as the scad file scales the imported svg (whose pixels are unit_mm) on the OpenSCAD route."""
+        with self._dimensions_lock:
+            if dimensions_file:
+                self._set_dimensions(dimensions_file)
+            width_mm = self.im_width_px * 25.4 / self.im_dpi
+            height_mm = self.im_height_px * 25.4 / self.im_dpi
+        # Same axes as the scad file's scale([scale_factor_y, scale_factor_x])
+        return unit_mm * self.image_height / height_mm, unit_mm * self.image_width / width_mm
+
+    def _fill(self, polygons, digest, unit_mm, result_file, dimensions_file=None):
+        import cv2
+
+        from fill_paths import PATTERNS, fill_polygons
+
+        line_distance = float(self.conf["slicer"]["infill_line_distance"])
+        pattern = self.conf["slicer"]["infill_pattern"]
+        if pattern not in PATTERNS:
+            print(f"Warning: native fill has no {pattern} pattern, using concentric")
+            pattern = "concentric"
+        scale_x, scale_y = self._fill_scale(unit_mm, dimensions_file)
+        key = ArtifactCache.key(
+            "fill", (), {"polygons": digest, "scale": (scale_x, scale_y), "line_distance": line_distance, "pattern": pattern, "compression": self.compression},
+            (cv2.__version__, source_version("fill_paths.py", "contour_trace.py")),
+        )
+        return self._cached(key, [result_file], lambda: fill_polygons(polygons(), result_file, scale_x, scale_y, line_distance, pattern) is not None)
+
+    def _fill_level(self, source, result_file):
+        """Native fill of a level, from its mask in memory (source is the color) or its i2gc preview PNG."""
+        from contour_trace import read_mask, trace_contours
+
+        mask = self._masks[source] if self._masks is not None else read_mask(source)
+        # Traced polygons are in pixels, which the svg route imports as points
+        return self._fill(lambda: trace_contours(mask), hashlib.sha256(mask.tobytes()).hexdigest(), 25.4 / 72, result_file)
+
+    def _fill_svg(self, svg_file, result_file, dimensions_file=None):
+        """Native fill of an svg, rendered at 4x its pixel size and traced."""
+        density = 4
+
+        def polygons():
+            import numpy as np
+            from wand.color import Color
+            from wand.image import Image as WImage
+
+            from contour_trace import trace_contours
+
+            with WImage(filename=svg_file, resolution=96 * density, background=Color("white")) as img:
+                img.alpha_channel = "remove"
+                img.format = "gray"
+                img.depth = 8
+                mask = np.frombuffer(img.make_blob(), dtype=np.uint8).reshape(img.height, img.width) < 128
+            return trace_contours(mask, upsample=1)
+
+        with open(svg_file, "rb") as fh:
+            digest = hashlib.sha256(fh.read()).hexdigest()
+        # svg pixels are 1/96 inch, as OpenSCAD imports them
+        return self._fill(polygons, digest, 25.4 / 96 / density, result_file, dimensions_file)
+
+    def _trace_opencv(self, mask, result_file):
+        """Trace a mask to an SVG in this process, in place of PBM + potrace."""
+        import cv2
+
+        from contour_trace import trace_svg
+
+        epsilon = float(self.conf["separation"].get("trace_epsilon", 0.5))
+        key = ArtifactCache.key(
+            "opencv", (), {"mask": hashlib.sha256(mask.tobytes()).hexdigest(), "shape": mask.shape, "epsilon": epsilon},
+            (cv2.__version__, source_version("contour_trace.py")),
+        )
+        return self._cached(key, [result_file], lambda: trace_svg(mask, result_file, epsilon) is not None)
+
+    def _trace_png(self, orig_file, result_file):
+        from contour_trace import read_mask
+
+        return self._trace_opencv(read_mask(orig_file), result_file)
+
+    def _trace_mask(self, color, pbm_file, result_file):
+        mask = self._masks[color]
+        if self.tracer == "opencv":
+            return self._trace_opencv(mask, result_file)
+
+        def trace():
+            from PIL import Image
+
+            # potrace traces the black pixels, which are 0 in PIL's 1-bit mode
+            Image.fromarray(~mask).save(pbm_file)
+            return subprocess.run(["potrace", pbm_file, "-s", "-o", result_file]).returncode == 0
+
+        key = ArtifactCache.key("potrace", (), {"mask": hashlib.sha256(mask.tobytes()).hexdigest(), "shape": mask.shape}, tool_version("potrace", "--version"))
+        return self._cached(key, [pbm_file, result_file], trace)
 
     def _convert_jpg_to_svg(self, orig_file, pbm_file, result_file):
-        subprocess.run(["convert", orig_file, pbm_file])
-        subprocess.run(["potrace", pbm_file, "-s", "-o", result_file])  # "-t", "100", "-O", "0.7"
+        def trace():
+            if subprocess.run(["convert", orig_file, pbm_file]).returncode != 0:
+                return False
+            return subprocess.run(["potrace", pbm_file, "-s", "-o", result_file]).returncode == 0  # "-t", "100", "-O", "0.7"
 
-    def _convert_jpgs_to_svgs(self):
-        base_file = os.path.splitext(self.file)[0]
-        for color in self.colors:
-            if color in self.conf["separation"]["selection"]:
-                color_level = self.conf["separation"]["selection"][color]
-            elif color in self.conf["separation"]["selection"]["additionals"]:
-                color_level = self.conf["separation"]["selection"]["additionals"][color]
-            else:
-                print(f"Warning: unhandled color: {color}")
-                continue
-
-            color_name = cmyk_to_name.get(color, color)
-            self._convert_jpg_to_svg(
-                f"{base_file}_{color}_{color_level}.png",
-                f"threshold_{color_name}.pbm",
-                f"threshold_{color_name}.svg",
-            )
+        key = ArtifactCache.key("potrace", [orig_file], None, (tool_version("convert", "-version"), tool_version("potrace", "--version")))
+        return self._cached(key, [pbm_file, result_file], trace)
@@ -11,19 +11,23 @@ def main():
     argparser.add_argument("-o", "--output", dest="output", default=None, help="Output file (gcode)", type=str)
     argparser.add_argument("-c", "--configuration", dest="configuration", default=None, help="Configuration file (conf)", type=str, required=True)
     argparser.add_argument("-s", "--steps", dest="steps", default="all", help="Steps (possible values: all, cmyk, gcode)", type=str)
+    argparser.add_argument("--cache-dir", dest="cache_dir", default="brushograph_cache", help="Directory caching stage outputs by their inputs", type=str)
+    argparser.add_argument("--cache-size", dest="cache_size", default=2048, help="Cache size limit in MB, least recently used entries are evicted", type=int)
+    argparser.add_argument("--no-cache", dest="cache_dir", action="store_const", const=None, help="Run every stage, without the cache")
+    argparser.add_argument("-j", "--jobs", dest="jobs", default=None, help="Pipeline stages run at once (default: CPU count)", type=int)
+    argparser.add_argument("--compress", dest="compression", default=None, choices=["gzip", "zstd"], help="Write the G-code of every stage compressed (.gz or .zst)", type=str)
+    argparser.add_argument("--stats", dest="stats", default=None, help="Write the stage timers and counters to this JSON file", type=str)
     argparser.add_argument("-v", "--verbose", dest="verbose", default=False, action="store_true", help="Verbose")
     args = argparser.parse_args()
 
     if args.verbose:
-        import sys
-
         print("Configuration:")
         for key, value in vars(args).items():
             print(f"  {key}={value}")
 
-        from utils import trace_py_files
+        from utils import trace_py_imports
 
-        sys.settrace(trace_py_files)
+        trace_py_imports()
 
     print("Processing image (CMYK)")
     from image_to_gcode_adaptive import CMYK
@@ -33,12 +37,19 @@ def main():
         output=args.output,
         configuration=args.configuration,
         steps=args.steps,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size << 20,
+        workers=args.jobs,
+        compression=args.compression,
     )
     cmyk.process()
 
+    if args.stats:
+        cmyk.stats.write(args.stats)
     if args.verbose:
         from utils import all_traced_filenames
 
+        print(f"Stages:\n{cmyk.stats}")
         print(f"All accessed python files: {all_traced_filenames}")
 
     print("Done image_to_gcode_runner.")
@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+import math
+from collections import deque
+
+import numpy as np
+
+from gcode_reader import read_gcode, matches, get_xy
+
+
+def read_strokes(gcode_path):
+    """Return the painted strokes of a slicer file as point lists, following Copicograf.prepare_path's state machine.
+
+    A stroke starts at the first point after a pen down (Z1) or a G92 E0 and ends at the next one, so the painted
+    distance of a file is the sum of the stroke lengths exactly as prepare_path counts it.
+    """
+    strokes = []
+    brush_on_canvas = move_to_other_shape = extruding = False
+    for line in read_gcode(gcode_path):
+        if matches(line, 1, F=600, Z=6):
+            brush_on_canvas = False
+        if matches(line, 1, F=600, Z=1):
+            brush_on_canvas = move_to_other_shape = True
+        if matches(line, 92, E=0) and brush_on_canvas:
+            extruding = True
+            continue
+        point = get_xy(line)
+        if point is None or not brush_on_canvas:
+            continue
+        if move_to_other_shape or extruding:
+            if move_to_other_shape:
+                move_to_other_shape = False
+            else:
+                extruding = False
+            strokes.append([point])
+        elif strokes:
+            strokes[-1].append(point)
+    return strokes
+
+
+class PaintPlan:
+    """Planned paint dips along a file's painted distance.
+
+    distances are the cumulative painted distances at which to dip, in increasing order; at_start marks dips taken at a
+    stroke's first point, before the brush goes down.
+    """
+
+    def __init__(self, distances, at_start, tray_travel, naive_dips, naive_tray_travel):
+        self.distances = distances
+        self.at_start = at_start
+        self.tray_travel = tray_travel
+        self.naive_dips = naive_dips
+        self.naive_tray_travel = naive_tray_travel
+
+    def __len__(self):
+        return len(self.distances)
+
+
+def _candidates(strokes, step):
+    """Every stroke vertex, plus points every `step` mm along longer segments, with their cumulative painted distance."""
+    s, xy, at_start = [], [], []
+    total = 0.0
+    for stroke in strokes:
+        s.append(total)
+        xy.append(stroke[0])
+        at_start.append(True)
+        for (x1, y1), (x2, y2) in zip(stroke, stroke[1:]):
+            dist = math.hypot(x2 - x1, y2 - y1)
+            for k in range(1, math.ceil(dist / step)):
+                s.append(total + k * step)
+                xy.append((x1 + (x2 - x1) * k * step / dist, y1 + (y2 - y1) * k * step / dist))
+                at_start.append(False)
+            total += dist
+            s.append(total)
+            xy.append((x2, y2))
+            at_start.append(False)
+    return np.array(s), np.array(xy).reshape(-1, 2), np.array(at_start, dtype=bool), total
+
+
+def plan_paint_dips(gcode_path, tray_x, tray_y, paint_min, paint_max, offset_x=0.0, offset_y=0.0, dip_overhead=0.0):
+    """Pick dip points so that each run paints between paint_min and paint_max mm with the least total tray travel.
+
+    Each dip costs the round trip from its point to the tray plus dip_overhead, so fewer trips win when distances are
+    equal. Runs carry on across shape boundaries, so a dip can wait for the start of the next shape. Solved exactly as a
+    shortest path over the candidate points, with a sliding window minimum over the allowed run lengths.
+    """
+    strokes = read_strokes(gcode_path)
+    s, xy, at_start, total = _candidates(strokes, max((paint_max - paint_min) / 2, 1))
+    # Round trip from the dip point to the tray and back
+    cost = 2 * np.hypot(xy[:, 0] + offset_x - tray_x, xy[:, 1] + offset_y - tray_y)
+
+    # Node 0 is the dip taken before painting starts, node k + 1 a dip at candidate k
+    positions = [0.0] + s.tolist()
+    weights = [0.0] + (cost + dip_overhead).tolist()
+    best = [math.inf] * len(positions)
+    parent = [-1] * len(positions)
+    best[0] = 0.0
+    window = deque()
+    j = 0
+    for k in range(1, len(positions)):
+        while j < k and positions[j] <= positions[k] - paint_min:
+            if best[j] < math.inf:
+                while window and best[window[-1]] >= best[j]:
+                    window.pop()
+                window.append(j)
+            j += 1
+        while window and positions[window[0]] < positions[k] - paint_max:
+            window.popleft()
+        if window:
+            best[k] = weights[k] + best[window[0]]
+            parent[k] = window[0]
+    finals = [k for k in range(len(positions)) if total - positions[k] <= paint_max and best[k] < math.inf]
+    k = min(finals, key=lambda k: best[k]) if finals else 0
+    dips = []
+    while k > 0:
+        dips.append(k - 1)
+        k = parent[k]
+    dips = np.array(dips[::-1], dtype=np.int64)
+
+    # The unplanned policy dips whenever the run reaches paint_per_run, taken here as the middle of the window
+    naive_run = (paint_min + paint_max) / 2
+    naive = np.searchsorted(s, np.arange(naive_run, total, naive_run))
+    naive = naive[naive < len(s)]
+    return PaintPlan(s[dips], at_start[dips], float(cost[dips].sum()), len(naive), float(cost[naive].sum()))
@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+import math
+import time
+
+import numpy as np
+
+from gcode_reader import open_gcode, tokenize, matches, get_xy
+
+# Pen down and pen up markers as the slicers write them, recognized without tokenizing
+_MARKER_LINES = {"G1 F600 Z1": 1, "G1 F600 Z6": 6}
+
+
+def _point(text):
+    """(x, y) of a G0/G1 line setting both axes, else None. Plain "G1 X.. Y.. [E..] [F..]" lines skip the tokenizer."""
+    if text[:4] in ("G1 X", "G0 X") and ";" not in text and "(" not in text:
+        parts = text.split()
+        if len(parts) > 2 and parts[2][:1] == "Y" and all(part[:1] in ("E", "F") for part in parts[3:]):
+            try:
+                return float(parts[1][1:]), float(parts[2][1:])
+            except ValueError:
+                pass
+    if text in _MARKER_LINES:
+        return None
+    line = tokenize(text)
+    return None if line is None else get_xy(line)
+
+
+def _marker(text):
+    """1 for a pen down (Z1) marker, 6 for a pen up (Z6) marker, None for any other line."""
+    if text in _MARKER_LINES:
+        return _MARKER_LINES[text]
+    if "Z" not in text and "z" not in text:
+        return None
+    line = tokenize(text)
+    if line is None:
+        return None
+    return 1 if matches(line, 1, F=600, Z=1) else 6 if matches(line, 1, F=600, Z=6) else None
+
+
+def _is_reset_e(text):
+    """True for a "G92 E0" line."""
+    if "G92" not in text and "g92" not in text:
+        return False
+    line = tokenize(text)
+    return line is not None and matches(line, 92, E=0)
+
+
+class Shape:
+    """One pen-down stretch of a slicer toolpath: the lines from a Z1 marker up to the next Z6 marker.
+
+    Only the start and end points are parsed up front; the polyline is parsed when the shape is written reversed.
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.reversible = True
+        self.start = None
+        self.end = None
+
+    def finish(self):
+        """Find the start and end points once all lines are in. Returns False for a shape without any."""
+        self.start = next(filter(None, map(_point, self.lines)), None)
+        self.end = next(filter(None, map(_point, reversed(self.lines))), None)
+        return self.start is not None
+
+    @property
+    def points(self):
+        return [point for point in map(_point, self.lines) if point is not None]
+
+    def emit(self, reverse=False):
+        start = self.end if reverse else self.start
+        yield "G1 F600 Z6"
+        yield f"G0 X{start[0]} Y{start[1]}"
+        if not reverse:
+            yield from self.lines
+            return
+        yield "G1 F600 Z1"
+        for x, y in reversed(self.points):
+            yield f"G1 X{x} Y{y}"
+
+
+def read_shapes(gcode_path):
+    """Split a slicer G-code file into (prelude, shapes, epilogue) at the pen up (Z6) and pen down (Z1) markers.
+
+    The prelude is everything before the first marker and the epilogue everything after the last pen up. Travel
+    lines between shapes are dropped, since the reordered output replaces them with a single move.
+    """
+    prelude, shapes, epilogue = [], [], None
+    shape = None
+    with open_gcode(gcode_path) as fh:
+        for text in fh:
+            text = text.rstrip("\n")
+            marker = _marker(text)
+            if marker == 1:
+                shape = Shape()
+                shapes.append(shape)
+            elif marker == 6:
+                shape = None
+                epilogue = []
+                continue
+            if shape is None:
+                (prelude if epilogue is None else epilogue).append(text)
+                continue
+            if _is_reset_e(text) and any(map(_point, shape.lines)):
+                # A mid-shape G92 E0 lifts the brush in Copicograf, which a reversed polyline would lose
+                shape.reversible = False
+            shape.lines.append(text)
+    return prelude, [shape for shape in shapes if shape.finish()], epilogue
+
+
+def travel_distance(entries, exits, origin=(0.0, 0.0)):
+    """Pen-up travel from origin through the shapes in order, given each shape's entry and exit points."""
+    if not len(entries):
+        return 0.0
+    previous = np.vstack([origin, exits[:-1]])
+    return float(np.hypot(*(entries - previous).T).sum())
+
+
+class _Grid:
+    """Uniform grid over shape endpoints for nearest-neighbour queries, with removal of visited shapes."""
+
+    def __init__(self, points, ids, size):
+        self.points = points
+        self.size = size
+        self.cells = {}
+        for n in ids:
+            self.cells.setdefault(self._cell(*points[n]), set()).add(n)
+
+    def _cell(self, x, y):
+        return (math.floor(x / self.size), math.floor(y / self.size))
+
+    def remove(self, n):
+        cell = self._cell(*self.points[n])
+        if cell not in self.cells:
+            return
+        self.cells[cell].discard(n)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def nearest(self, x, y):
+        cx, cy = self._cell(x, y)
+        cells, points, size = self.cells, self.points, self.size
+        # Distance from the query to the border of its cell: no point outside rings 0..r is closer than r cells more
+        margin = min(x - cx * size, (cx + 1) * size - x, y - cy * size, (cy + 1) * size - y)
+        best, best_dist = None, math.inf
+        scanned = 0
+        r = 0
+        while cells:
+            if r == 0:
+                ring = [(cx, cy)]
+            else:
+                ring = [(cx + dx, cy + s * r) for dx in range(-r, r + 1) for s in (-1, 1)]
+                ring += [(cx + s * r, cy + dy) for dy in range(-r + 1, r) for s in (-1, 1)]
+            scanned += len(ring)
+            if scanned > len(cells):
+                # Few shapes left, spread out: scanning the occupied cells is cheaper than growing the ring
+                ring = cells
+            # The distance loop is inlined, as this runs once per shape
+            for cell in ring:
+                for n in cells.get(cell, ()):
+                    px, py = points[n]
+                    d = (px - x) ** 2 + (py - y) ** 2
+                    if d < best_dist:
+                        best, best_dist = n, d
+            if ring is cells:
+                return best
+            if best is not None and math.sqrt(best_dist) <= r * size + margin:
+                return best
+            r += 1
+        return best
+
+
+def nearest_neighbour_order(shapes, origin=(0.0, 0.0)):
+    """Greedy tour: always go to the closest free endpoint, entering a reversible shape from its end when that is closer."""
+    endpoints, ids = [], []
+    for k, shape in enumerate(shapes):
+        # Endpoint 2k enters shape k at its start, 2k + 1 at its end (reversed)
+        endpoints += [shape.start, shape.end]
+        ids += [2 * k, 2 * k + 1] if shape.reversible else [2 * k]
+    extent = np.ptp(np.array(endpoints), axis=0).max() if endpoints else 0
+    # About 8 endpoints per cell: most queries end in their own cell, with few cells to look up
+    grid = _Grid(endpoints, ids, max(2 * extent / max(math.sqrt(len(shapes)), 1), 1e-6))
+    order, reverse = [], []
+    x, y = origin
+    while grid.cells:
+        n = grid.nearest(x, y)
+        k = n // 2
+        grid.remove(2 * k)
+        grid.remove(2 * k + 1)
+        order.append(k)
+        reverse.append(n % 2 == 1)
+        x, y = shapes[k].start if n % 2 else shapes[k].end
+    return order, reverse
+
+
+def two_opt(shapes, order, reverse, window=30, passes=2, origin=(0.0, 0.0)):
+    """Windowed 2-opt: reverse runs of up to `window` consecutive shapes when that shortens the travel between them.
+
+    A run can only be reversed when every shape in it is reversible. Each round scores every run at once, one run
+    length at a time, then applies the best improving runs that share no link, so they add up; passes is the number
+    of rounds.
+    """
+    order, reverse = np.array(order, dtype=np.int64), np.array(reverse, dtype=bool)
+    n = len(order)
+    starts = np.array([shape.start for shape in shapes]).reshape(-1, 2)
+    ends = np.array([shape.end for shape in shapes]).reshape(-1, 2)
+    fixed = np.array([not shape.reversible for shape in shapes], dtype=np.int64)
+    positions = np.arange(n)
+    for _ in range(passes):
+        entries = np.where(reverse[:, None], ends[order], starts[order])
+        exits = np.where(reverse[:, None], starts[order], ends[order])
+        blocked = np.concatenate([[0], np.cumsum(fixed[order])])
+        # Where the tool comes from before each position: the origin, then the previous shape's exit
+        before = np.vstack([origin, exits[:-1]]).reshape(-1, 2)
+        first = np.hypot(*(entries - before).T)
+        # Best gain and run end per run start a, reversing order[a : j + 1]
+        best_gain, best_end = np.zeros(n), np.zeros(n, dtype=np.int64)
+        for length in range(2, window + 1):
+            j = positions + length - 1
+            valid = (j < n) & (blocked[np.minimum(j + 1, n)] == blocked[positions])
+            j = np.minimum(j, n - 1)
+            has_next = j + 1 < n
+            following = entries[np.minimum(j + 1, n - 1)]
+            old = first + np.where(has_next, np.hypot(*(following - exits[j]).T), 0)
+            new = np.hypot(*(exits[j] - before).T) + np.where(has_next, np.hypot(*(following - entries).T), 0)
+            gain = np.where(valid, old - new, 0)
+            better = gain > best_gain
+            best_gain[better], best_end[better] = gain[better], j[better]
+        candidates = np.flatnonzero(best_gain > 1e-9)
+        if not len(candidates):
+            break
+        # Run a..j changes links a - 1 to j (link t joins positions t and t + 1, link -1 the origin)
+        taken = np.zeros(n + 1, dtype=bool)
+        for a in candidates[np.argsort(-best_gain[candidates], kind="stable")].tolist():
+            j = int(best_end[a])
+            if taken[a : j + 2].any():
+                continue
+            taken[a : j + 2] = True
+            order[a : j + 1] = order[a : j + 1][::-1].copy()
+            reverse[a : j + 1] = ~reverse[a : j + 1][::-1]
+    return order.tolist(), reverse.tolist()
+
+
+def _travel(shapes, order, reverse, origin):
+    entries = np.array([shapes[k].end if r else shapes[k].start for k, r in zip(order, reverse)]).reshape(-1, 2)
+    exits = np.array([shapes[k].start if r else shapes[k].end for k, r in zip(order, reverse)]).reshape(-1, 2)
+    return travel_distance(entries, exits, origin)
+
+
+def reorder_shapes(gcode_path, result_file, window=30, passes=2, origin=(0.0, 0.0)):
+    """Rewrite a slicer G-code file with its shapes reordered (and reversed where allowed) to cut pen-up travel.
+
+    Returns the travel distance in mm before and after.
+    """
+    start_time = time.perf_counter()
+    prelude, shapes, epilogue = read_shapes(gcode_path)
+    before = _travel(shapes, range(len(shapes)), [False] * len(shapes), origin)
+    order, reverse = nearest_neighbour_order(shapes, origin)
+    order, reverse = two_opt(shapes, order, reverse, window, passes, origin)
+    after = _travel(shapes, order, reverse, origin)
+    with open_gcode(result_file, "w") as fh:
+        for text in prelude:
+            fh.write(text + "\n")
+        for k, r in zip(order, reverse):
+            fh.write("\n".join(shapes[k].emit(r)) + "\n")
+        fh.write("G1 F600 Z6\n")
+        for text in epilogue or []:
+            fh.write(text + "\n")
+    print(f"Reordered {len(shapes)} shapes in {time.perf_counter() - start_time:.2f}s, travel {before:.0f}mm -> {after:.0f}mm")
+    return before, after
+
+
+def main():
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-i", "--input", dest="input", default=None, help="Input slicer gcode", type=str, required=True)
+    argparser.add_argument("-o", "--output", dest="output", default=None, help="Output gcode with reordered shapes", type=str, required=True)
+    argparser.add_argument("-w", "--window", dest="window", default=30, help="2-opt window in shapes", type=int)
+    argparser.add_argument("-p", "--passes", dest="passes", default=2, help="Maximum 2-opt rounds", type=int)
+    args = argparser.parse_args()
+
+    reorder_shapes(args.input, args.output, args.window, args.passes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+import contextlib
+import json
+import threading
+import time
+
+
+class StageStats:
+    """Wall time and counters per stage, summed over calls, threads and worker processes.
+
+    Stages count in local variables and add their totals once per call, so the stats stay on in normal runs. Stage
+    names are "tool:stage", e.g. "i2gc:level" or "copicograf:prepare_path"; the counters used are pixels, strokes,
+    moves, dips, washes, painted_mm and bytes.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"stages": self.stages}
+
+    def __setstate__(self, state):
+        self.stages = state["stages"]
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds=0.0, **counters):
+        """Add one call of a stage that took seconds, with its counters."""
+        self.merge({stage: {"calls": 1, "seconds": seconds, **counters}})
+
+    def merge(self, stages):
+        """Add the stages of another StageStats, e.g. from a worker process or a subprocess's JSON report."""
+        with self._lock:
+            for stage, entry in stages.items():
+                total = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0})
+                for name, value in entry.items():
+                    total[name] = total.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """Time a block as one call of stage; the block fills the yielded dict with its counters."""
+        counters = {}
+        start_time = time.perf_counter()
+        try:
+            yield counters
+        finally:
+            self.add(stage, time.perf_counter() - start_time, **counters)
+
+    def report(self):
+        with self._lock:
+            return {"stages": {stage: dict(entry) for stage, entry in self.stages.items()}}
+
+    def write(self, json_file):
+        with open(json_file, "w") as fh:
+            json.dump(self.report(), fh, indent=1)
+
+    def load(self, json_file):
+        """Merge a report written by write()."""
+        with open(json_file) as fh:
+            self.merge(json.load(fh)["stages"])
+
+    def __str__(self):
+        lines = []
+        for stage, entry in self.report()["stages"].items():
+            counters = ", ".join(f"{name} {value:.1f}" if isinstance(value, float) else f"{name} {value}" for name, value in entry.items() if name not in ("calls", "seconds"))
+            lines.append(f"{stage}: {entry['calls']} calls, {entry['seconds']:.2f}s" + (f", {counters}" if counters else ""))
+        return "\n".join(lines)
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class TaskFailed(RuntimeError):
+    pass
+
+
+class TaskGraph:
+    """Tasks with dependencies, run on a bounded thread pool as soon as everything they depend on has finished.
+
+    Task names are "stage:item", e.g. "slicer:cyan", so the timing report can sum them per stage. A task fails when it
+    raises or returns False; nothing new is started after that, the running tasks are waited for and TaskFailed raised.
+    """
+
+    def __init__(self, workers=None, stats=None):
+        self.workers = workers or os.cpu_count() or 1
+        # Optional StageStats the task times are added to, as "pipeline:stage"
+        self.stats = stats
+        self.tasks = {}
+        self.times = {}
+
+    def add(self, name, fn, deps=()):
+        missing = [dep for dep in deps if dep not in self.tasks]
+        if missing:
+            raise ValueError(f"Task {name} depends on unknown tasks {missing}")
+        self.tasks[name] = (fn, tuple(deps))
+        return name
+
+    def _run_task(self, name):
+        fn, _ = self.tasks[name]
+        start_time = time.perf_counter()
+        try:
+            return fn() is not False
+        except Exception:
+            traceback.print_exc()
+            return False
+        finally:
+            self.times[name] = (start_time, time.perf_counter())
+            if self.stats is not None:
+                self.stats.add(f"pipeline:{name.split(':')[0]}", self.times[name][1] - start_time)
+
+    def run(self):
+        start_time = time.perf_counter()
+        waiting = {name: set(deps) for name, (_, deps) in self.tasks.items()}
+        failed = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                running = {}
+                while waiting or running:
+                    if not failed:
+                        for name in [name for name, deps in waiting.items() if not deps]:
+                            del waiting[name]
+                            running[executor.submit(self._run_task, name)] = name
+                    if not running:
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        if not future.result():
+                            print(f"Task {name} failed, not starting {len(waiting)} remaining tasks")
+                            failed.append(name)
+                            continue
+                        for deps in waiting.values():
+                            deps.discard(name)
+        finally:
+            self.report(time.perf_counter() - start_time, start_time)
+        if failed:
+            raise TaskFailed(f"Failed tasks: {', '.join(failed)}")
+
+    def report(self, total, start_time):
+        stages = {}
+        for name, (start, end) in self.times.items():
+            stage = name.split(":")[0]
+            stages.setdefault(stage, []).append(end - start)
+        print(f"Task graph: {len(self.times)} of {len(self.tasks)} tasks in {total:.1f}s on {self.workers} workers")
+        for stage, times in stages.items():
+            print(f"  {stage}: {len(times)} tasks, {sum(times):.1f}s total, {max(times):.1f}s longest")
+        for name, (start, end) in sorted(self.times.items(), key=lambda item: item[1][0]):
+            print(f"    {name}: {start - start_time:.1f}s -> {end - start_time:.1f}s")
@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+import json
+import math
+import time
+
+import numpy as np
+
+from gcode_reader import open_gcode, tokenize
+
+CATEGORIES = ("painting", "travel", "dipping", "washing")
+_MOTION_WORDS = ("G0", "G1", "G00", "G01")
+
+
+def segment_time(dist, speed, acc):
+    """Time of a trapezoidal (or triangular) move from rest to rest."""
+    if dist <= 0 or speed <= 0:
+        return 0.0
+    if acc <= 0:
+        return dist / speed
+    if dist >= speed * speed / acc:
+        return dist / speed + speed / acc
+    return 2 * math.sqrt(dist / acc)
+
+
+class Estimator:
+    """Replay a G-code stream with the feed rates and accelerations it sets and sum the time of every move.
+
+    Feed rates (G0/G1 F) are mm/min, M203 maximum rates mm/s and M204 accelerations mm/s^2, as in Marlin. M204 P applies
+    to extruding moves and T to the others (S sets both). Moves start and end at rest.
+    """
+
+    def __init__(self, conf=None, feedrate=1000.0, acceleration=500.0, paint_z=None):
+        self.feedrate = feedrate
+        self.print_acc = acceleration
+        self.travel_acc = acceleration
+        self.max_rate = {"X": math.inf, "Y": math.inf, "Z": math.inf}
+        self.position = (0.0, 0.0, 0.0)
+        self.absolute = True
+        self.trays = []
+        self.tray_radius = 0.0
+        if conf:
+            brushograph = conf["brushograph"]
+            self.tray_radius = max(float(brushograph["tray_enter_radius"]), float(brushograph["remove_drops_radius"])) + 1
+            for name, tray in conf["trays"].items():
+                if name == "additionals":
+                    self.trays += [("dipping", float(t["x"]), float(t["y"])) for t in tray.values()]
+                else:
+                    self.trays.append(("washing" if name == "water" else "dipping", float(tray["x"]), float(tray["y"])))
+        if paint_z is None:
+            # Copicograf paints at canvas_height; i2gc lowers the pen below zero
+            paint_z = float(conf["brushograph"]["canvas_height"]) if conf else -1e-3
+        self.paint_z = paint_z
+        self._paint_limit = paint_z + 1e-6
+        self.times = dict.fromkeys(CATEGORIES, 0.0)
+        self.distances = dict.fromkeys(CATEGORIES, 0.0)
+        self.moves = 0
+        self._last_tray = None
+        # Plain moves wait here as their axis words, feed rate, acceleration and maximum rates, timed together in flush()
+        self._batch = []
+
+    def _tray(self, x, y):
+        for category, tray_x, tray_y in self.trays:
+            if (x - tray_x) ** 2 + (y - tray_y) ** 2 <= self.tray_radius**2:
+                return category
+        return None
+
+    def move(self, words):
+        self.flush()
+        x, y, z = self.position
+        if self.absolute:
+            tx, ty, tz = words.get("X", x), words.get("Y", y), words.get("Z", z)
+        else:
+            tx, ty, tz = x + words.get("X", 0.0), y + words.get("Y", 0.0), z + words.get("Z", 0.0)
+        dx, dy, dz = tx - x, ty - y, tz - z
+        dist = math.sqrt(dx * dx + dy * dy + dz * dz)
+        if dist > 0:
+            speed = self.feedrate / 60
+            for d, max_rate in ((dx, self.max_rate["X"]), (dy, self.max_rate["Y"]), (dz, self.max_rate["Z"])):
+                if d:
+                    speed = min(speed, max_rate * dist / abs(d))
+            acc = self.print_acc if "E" in words else self.travel_acc
+            # A move touching a tray belongs to that tray's trip, otherwise it paints when it stays down on the canvas
+            end_tray = self._tray(tx, ty) if self.trays else None
+            category = self._last_tray or end_tray
+            if not category:
+                category = "painting" if max(z, tz) <= self._paint_limit and (dx or dy) else "travel"
+            self._last_tray = end_tray
+            self.times[category] += segment_time(dist, speed, acc)
+            self.distances[category] += dist
+            self.moves += 1
+        self.position = (tx, ty, tz)
+
+    def fast_line(self, text):
+        """Queue a plain "G0/G1 [X..] [Y..] [Z..] [E..] [F..]" line for flush() without tokenizing it into words.
+
+        Returns False, having done nothing, for any other line, which then goes through feed().
+        """
+        parts = text.split()
+        if not parts or parts[0] not in _MOTION_WORDS or ";" in text or "(" in text:
+            return False
+        # Axes the line leaves out stay NaN until flush() fills them in
+        x = y = z = math.nan
+        feedrate = None
+        extrude = False
+        try:
+            for part in parts[1:]:
+                letter = part[0]
+                if letter == "X":
+                    x = float(part[1:])
+                elif letter == "Y":
+                    y = float(part[1:])
+                elif letter == "Z":
+                    z = float(part[1:])
+                elif letter == "E":
+                    float(part[1:])
+                    extrude = True
+                elif letter == "F":
+                    feedrate = float(part[1:])
+                else:
+                    return False
+        except ValueError:
+            return False
+        if feedrate is not None:
+            self.feedrate = feedrate
+        max_rate = self.max_rate
+        self._batch.append((x, y, z, self.feedrate, self.print_acc if extrude else self.travel_acc, max_rate["X"], max_rate["Y"], max_rate["Z"]))
+        if len(self._batch) >= 1 << 16:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Time the queued moves at once, as move() would one by one."""
+        if not self._batch:
+            return
+        batch = np.array(self._batch, dtype=np.float64)
+        self._batch = []
+        # Targets, from the current position: missing axes keep the previous value, relative moves add up
+        coordinates = np.vstack([self.position, batch[:, :3]])
+        if self.absolute:
+            given = ~np.isnan(coordinates)
+            last = np.maximum.accumulate(np.where(given, np.arange(len(coordinates))[:, None], 0), axis=0)
+            coordinates = np.take_along_axis(coordinates, last, axis=0)
+        else:
+            coordinates = np.cumsum(np.nan_to_num(coordinates), axis=0)
+        sources, targets = coordinates[:-1], coordinates[1:]
+        self.position = tuple(float(value) for value in targets[-1])
+        delta = targets - sources
+        dist = np.sqrt((delta * delta).sum(axis=1))
+        # Moves of zero length take no time and leave the tray state alone
+        moving = dist > 0
+        delta, dist, sources, targets, batch = delta[moving], dist[moving], sources[moving], targets[moving], batch[moving]
+        if not len(dist):
+            return
+        speed, acc = batch[:, 3] / 60, batch[:, 4]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for axis in range(3):
+                d = np.abs(delta[:, axis])
+                speed = np.where(d > 0, np.minimum(speed, batch[:, 5 + axis] * dist / d), speed)
+            # segment_time over the whole batch
+            times = np.where(dist >= speed * speed / acc, dist / speed + speed / acc, 2 * np.sqrt(dist / acc))
+            times = np.where(speed > 0, np.where(acc > 0, times, dist / speed), 0.0)
+        # Category indices into CATEGORIES; a move takes the tray of the one before it, else its own, as in move()
+        end_tray = np.full(len(dist), -1)
+        for category, tray_x, tray_y in reversed(self.trays):
+            # Reversed, so the first tray in the list wins where trays overlap, like _tray()
+            near = (targets[:, 0] - tray_x) ** 2 + (targets[:, 1] - tray_y) ** 2 <= self.tray_radius**2
+            end_tray[near] = CATEGORIES.index(category)
+        last_tray = -1 if self._last_tray is None else CATEGORIES.index(self._last_tray)
+        category = np.concatenate([[last_tray], end_tray[:-1]])
+        category = np.where(category < 0, end_tray, category)
+        painting = (np.maximum(sources[:, 2], targets[:, 2]) <= self._paint_limit) & ((delta[:, 0] != 0) | (delta[:, 1] != 0))
+        category = np.where(category < 0, np.where(painting, 0, 1), category)
+        self._last_tray = None if end_tray[-1] < 0 else CATEGORIES[end_tray[-1]]
+        for n, name in enumerate(CATEGORIES):
+            self.times[name] += float(times[category == n].sum())
+            self.distances[name] += float(dist[category == n].sum())
+        self.moves += len(dist)
+
+    def feed(self, line):
+        gcodes, words, _ = line
+        if gcodes:
+            # Queued moves are timed in the positioning mode and from the position they were queued in; feed rates,
+            # accelerations and maximum rates are stored per move
+            self.flush()
+        if "F" in words and (not gcodes or 0.0 in gcodes or 1.0 in gcodes):
+            self.feedrate = words["F"]
+        for g in gcodes:
+            if g == 90.0:
+                self.absolute = True
+            elif g == 91.0:
+                self.absolute = False
+            elif g == 92.0:
+                self.position = tuple(words.get(axis, value) for axis, value in zip("XYZ", self.position))
+                self._last_tray = None
+            elif g == 28.0:
+                # The tokenizer drops valueless words like "G28 X Y", so a bare G28 is taken as homing X and Y
+                homed = [axis for axis in "XYZ" if axis in words] or ["X", "Y"]
+                self.move({axis: 0.0 if self.absolute else -value for axis, value in zip("XYZ", self.position) if axis in homed})
+        if 0.0 in gcodes or 1.0 in gcodes:
+            self.move(words)
+        elif "M" in words and words["M"] == 204:
+            self.print_acc = words.get("P", words.get("S", self.print_acc))
+            self.travel_acc = words.get("T", words.get("S", self.travel_acc))
+        elif "M" in words and words["M"] == 203:
+            self.max_rate.update({axis: words[axis] for axis in "XYZ" if axis in words})
+
+    def report(self):
+        self.flush()
+        total = sum(self.times.values())
+        return {
+            "total_s": total,
+            "moves": self.moves,
+            **{f"{category}_s": self.times[category] for category in CATEGORIES},
+            **{f"{category}_mm": self.distances[category] for category in CATEGORIES},
+        }
+
+
+def estimate(gcode_path, conf=None, feedrate=1000.0, acceleration=500.0, paint_z=None):
+    """Estimate the machine time of a Copicograf or i2gc output file, split into painting, travel, dipping and washing."""
+    estimator = Estimator(conf, feedrate, acceleration, paint_z)
+    lines = 0
+    start_time = time.perf_counter()
+    with open_gcode(gcode_path) as fh:
+        for text in fh:
+            # Plain moves, nearly every line, skip the tokenizer
+            if not estimator.fast_line(text):
+                line = tokenize(text)
+                if line is None:
+                    continue
+                estimator.feed(line)
+            lines += 1
+    report = estimator.report()
+    report["lines"] = lines
+    report["parse_s"] = time.perf_counter() - start_time
+    return report
+
+
+def format_duration(seconds):
+    hours, rest = divmod(round(seconds), 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}"
+
+
+def main():
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-i", "--input", dest="input", default=None, help="Input gcode (copicograf or i2gc output)", type=str, required=True)
+    argparser.add_argument("-c", "--configuration", dest="configuration", default=None, help="Configuration file (conf), for tray positions and canvas height", type=str)
+    argparser.add_argument("-F", "--feedrate", dest="feedrate", default=1000.0, help="Feed rate before the file sets one, in mm/min", type=float)
+    argparser.add_argument("-A", "--acceleration", dest="acceleration", default=500.0, help="Acceleration before the file sets one, in mm/s^2", type=float)
+    argparser.add_argument("-Z", "--paint_z", dest="paint_z", default=None, help="Moves at or below this Z count as painting", type=float)
+    argparser.add_argument("--json", dest="json", action="store_true", help="Print the report as JSON")
+    args = argparser.parse_args()
+
+    conf = None
+    if args.configuration:
+        with open(args.configuration) as f:
+            conf = json.load(f)
+
+    report = estimate(args.input, conf, args.feedrate, args.acceleration, args.paint_z)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"Total: {format_duration(report['total_s'])} ({report['moves']} moves, {report['lines']} lines in {report['parse_s']:.1f}s)")
+    for category in CATEGORIES:
+        print(f"  {category}: {format_duration(report[f'{category}_s'])}, {report[f'{category}_mm'] / 1000:.1f}m")
+
+
+if __name__ == "__main__":
+    main()
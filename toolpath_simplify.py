@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+import heapq
+import time
+
+import numpy as np
+
+from gcode_reader import open_gcode, tokenize, matches, get_xy
+
+
+def _segment_distance(points, a, b):
+    """Distance of each point to the segment a-b (to a itself when the segment is a single point)."""
+    ab = b - a
+    length = ab @ ab
+    t = np.zeros(len(points)) if length == 0 else np.clip((points - a) @ ab / length, 0, 1)
+    return np.hypot(*(points - a - t[:, None] * ab).T)
+
+
+def rdp_mask(points, tolerance):
+    """Ramer-Douglas-Peucker: mask of the points to keep so no dropped point is further than tolerance from the result."""
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        distances = _segment_distance(points[i + 1 : j], points[i], points[j])
+        k = int(np.argmax(distances))
+        if distances[k] > tolerance:
+            k += i + 1
+            keep[k] = True
+            stack += [(i, k), (k, j)]
+    return keep
+
+
+def visvalingam_mask(points, tolerance):
+    """Visvalingam-Whyatt: drop the point whose triangle with its neighbours is flattest while its height is below tolerance.
+
+    The height over the neighbours' chord is used instead of the area, so tolerance is in mm as for rdp_mask.
+    Dropping points one after another can move the result further than tolerance from the original path.
+    """
+    n = len(points)
+    keep = np.ones(n, dtype=bool)
+    previous = list(range(-1, n - 1))
+    following = list(range(1, n + 1))
+
+    def height(k):
+        return float(_segment_distance(points[k : k + 1], points[previous[k]], points[following[k]])[0])
+
+    heap = [(height(k), k) for k in range(1, n - 1)]
+    heapq.heapify(heap)
+    current = {k: h for h, k in heap}
+    while heap:
+        h, k = heapq.heappop(heap)
+        if not keep[k] or current[k] != h:
+            continue
+        if h > tolerance:
+            break
+        keep[k] = False
+        p, f = previous[k], following[k]
+        following[p], previous[f] = f, p
+        for neighbour in (p, f):
+            if 0 < neighbour < n - 1:
+                current[neighbour] = height(neighbour)
+                heapq.heappush(heap, (current[neighbour], neighbour))
+    return keep
+
+
+METHODS = {"rdp": rdp_mask, "visvalingam": visvalingam_mask}
+
+
+def max_deviation(points, keep):
+    """Largest distance of a dropped point from the kept segment that replaces it."""
+    kept = np.flatnonzero(keep)
+    dropped = np.flatnonzero(~keep)
+    if not len(dropped):
+        return 0.0
+    # Kept point just before each dropped one, and the one after it
+    start = kept[np.searchsorted(kept, dropped) - 1]
+    end = kept[np.searchsorted(kept, dropped)]
+    a, b, p = points[start], points[end], points[dropped]
+    ab = b - a
+    length = np.einsum("ij,ij->i", ab, ab)
+    t = np.clip(np.einsum("ij,ij->i", p - a, ab) / np.where(length > 0, length, 1), 0, 1)
+    return float(np.hypot(*(p - a - t[:, None] * ab).T).max())
+
+
+class SimplifyStats:
+    def __init__(self):
+        self.runs = 0
+        self.segments = 0
+        self.removed = 0
+        self.max_deviation = 0.0
+
+    def __str__(self):
+        return (
+            f"{self.removed} of {self.segments} segments removed ({100 * self.removed / max(self.segments, 1):.1f}%) "
+            f"in {self.runs} runs, max deviation {self.max_deviation:.4f}mm"
+        )
+
+
+def simplify_toolpath(gcode_path, result_file, tolerance=0.05, method="rdp"):
+    """Rewrite a slicer G-code file with the painted polylines simplified to within tolerance mm.
+
+    Only runs of plain X/Y moves with the brush down (after a Z1 marker) are simplified, and a run ends wherever
+    Copicograf.prepare_path starts a stroke. Every other line, the pen up and down markers, G92 E0 and moves that
+    change Z among them, is copied as is, so shape starts and ends and the brush structure are kept. Returns a
+    SimplifyStats.
+    """
+    simplify = METHODS[method]
+    stats = SimplifyStats()
+    start_time = time.perf_counter()
+    with open_gcode(gcode_path) as fh, open_gcode(result_file, "w") as out:
+        run_lines, run_points = [], []
+
+        def flush_run():
+            if len(run_points) > 2:
+                points = np.array(run_points)
+                keep = simplify(points, tolerance)
+                stats.runs += 1
+                stats.segments += len(run_points) - 1
+                stats.removed += len(run_points) - int(keep.sum())
+                stats.max_deviation = max(stats.max_deviation, max_deviation(points, keep))
+                out.writelines(text for text, k in zip(run_lines, keep) if k)
+            else:
+                stats.segments += max(len(run_points) - 1, 0)
+                out.writelines(run_lines)
+            run_lines.clear()
+            run_points.clear()
+
+        brush_on_canvas = move_to_other_shape = extruding = False
+        for text in fh:
+            line = tokenize(text)
+            point = get_xy(line) if line is not None else None
+            if brush_on_canvas and point is not None and "Z" not in line[1] and not line[2]:
+                if move_to_other_shape or extruding:
+                    # prepare_path starts a stroke here, one point after a pen down or G92 E0 each, so a run starts too
+                    if move_to_other_shape:
+                        move_to_other_shape = False
+                    else:
+                        extruding = False
+                    flush_run()
+                run_lines.append(text)
+                run_points.append(point)
+                continue
+            flush_run()
+            out.write(text)
+            if line is None:
+                continue
+            if matches(line, 1, F=600, Z=6):
+                brush_on_canvas = False
+            if matches(line, 1, F=600, Z=1):
+                brush_on_canvas = move_to_other_shape = True
+            if matches(line, 92, E=0) and brush_on_canvas:
+                extruding = True
+        flush_run()
+    print(f"Simplified {gcode_path} ({method}, {tolerance}mm) in {time.perf_counter() - start_time:.2f}s: {stats}")
+    return stats
+
+
+def main():
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-i", "--input", dest="input", default=None, help="Input slicer gcode", type=str, required=True)
+    argparser.add_argument("-o", "--output", dest="output", default=None, help="Output gcode with simplified polylines", type=str, required=True)
+    argparser.add_argument("-t", "--tolerance", dest="tolerance", default=0.05, help="Tolerance in mm", type=float)
+    argparser.add_argument("-m", "--method", dest="method", default="rdp", choices=list(METHODS), help="Simplification method", type=str)
+    args = argparser.parse_args()
+
+    simplify_toolpath(args.input, args.output, args.tolerance, args.method)
+
+
+if __name__ == "__main__":
+    main()
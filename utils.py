@@ -9,26 +9,43 @@ cmyk_to_name = {
 }
 
 # Debug utils
-last_traced_filename = None
 all_traced_filenames = set()
 
 
-def trace_py_files(frame, event, arg):
-    """Trace python files that are accessed. Usage: sys.settrace(trace_py_files)"""
-    if event == "call":
-        filename = frame.f_globals.get("__file__")
-        if filename and filename.endswith(".py"):
-            import os
-
-            filename = os.path.abspath(filename)
-            cwd = os.getcwd()
-
-            if filename.startswith(cwd):
-                filename = filename.removeprefix(cwd).removeprefix("/")
-                if "env" not in filename and "venv" not in filename:
-                    all_traced_filenames.add(filename)
-                    global last_traced_filename
-                    if filename != last_traced_filename:
-                        print(f"Accessing python file: {filename}")
-                    last_traced_filename = filename
-    return trace_py_files
+def _trace_py_file(filename):
+    import os
+
+    filename = os.path.abspath(filename)
+    cwd = os.getcwd()
+    if filename.endswith(".py") and filename.startswith(cwd):
+        filename = filename.removeprefix(cwd).removeprefix("/")
+        if "env" not in filename and "venv" not in filename and filename not in all_traced_filenames:
+            all_traced_filenames.add(filename)
+            print(f"Accessing python file: {filename}")
+
+
+class _ImportTracer:
+    """Meta path finder that only looks at where each imported module comes from and leaves the import to the others."""
+
+    def find_spec(self, fullname, path, target=None):
+        import importlib.machinery
+
+        spec = importlib.machinery.PathFinder.find_spec(fullname, path)
+        if spec is not None and spec.origin:
+            _trace_py_file(spec.origin)
+        return None
+
+
+def trace_py_imports():
+    """Trace the python files of this project that are used: those imported so far and every one imported later.
+
+    A hook on imports runs once per module, unlike a sys.settrace function that runs on every call.
+    """
+    import sys
+
+    for module in list(sys.modules.values()):
+        filename = getattr(module, "__file__", None)
+        if filename:
+            _trace_py_file(filename)
+    if not any(isinstance(finder, _ImportTracer) for finder in sys.meta_path):
+        sys.meta_path.insert(0, _ImportTracer())